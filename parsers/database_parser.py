@@ -1,26 +1,31 @@
 import argparse
-from processors.database import Database, Config
+from processors.database import Database, Config, FULL
 from processors.core import three_column_print
 
 def main(args):
     db = Database(Config(args.config))
 
+    if args.migrate is not None:
+        db.migrate_experiments(args.migrate, jobs = args.jobs)
+
     if args.list:
         three_column_print(db.update_experiment_list())
 
+    if args.search:
+        for id, matches in sorted(db.search_experiments(args.search).items()):
+            print(id + ''.join(f', {field} {value}' for field, value in matches))
+
     if args.delete:
-        for id in args.delete:
-            db.remove_experiment(id)
+        db.remove_experiments(args.delete)
 
     if args.inspect:
-        for id in args.inspect:
-            exp = db.pull_experiment(id)
+        for exp in db.pull_experiments(args.inspect, jobs = args.jobs):
             print(exp)
             exp.show_tables()
 
-    if args.download:
-        for id in args.download:
-            exp = db.pull_experiment(id)
+    if args.download is not None:
+        ids = args.download or db.update_experiment_list()
+        for exp in db.pull_experiments(ids, FULL, jobs = args.jobs):
             exp.save_csvs('.')
 
 parser = argparse.ArgumentParser(
@@ -38,6 +43,11 @@ parser.add_argument(
     help = 'Print list of all experiments in database',
     action = 'store_true'
 )
+parser.add_argument(
+    '-s', '--search',
+    help = 'Find experiments with an ID, sample, channel, sample set or instrument method starting with this',
+    type = str
+)
 parser.add_argument(
     '-d', '--delete',
     help = 'Delete experiment(s) by name',
@@ -50,9 +60,21 @@ parser.add_argument(
     type = str,
     nargs = '+'
 )
+parser.add_argument(
+    '--migrate',
+    help = 'Convert experiments saved by older versions of appia to the current format. Give experiment names, or no names to migrate every out of date experiment.',
+    type = str,
+    nargs = '*'
+)
 parser.add_argument(
     '--download',
-    help = 'Save experiments from the database as a .csv. Note that these may have been downsampled.',
+    help = 'Save experiments from the database as a .csv, or every experiment if no names are given. Experiments uploaded before HPLC pyramids were stored may have been downsampled.',
     type = str,
-    nargs = '+'
+    nargs = '*'
+)
+parser.add_argument(
+    '-j', '--jobs',
+    help = 'Number of experiments to download at once. Default 8.',
+    type = int,
+    default = 8
 )
\ No newline at end of file
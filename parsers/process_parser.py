@@ -4,11 +4,15 @@ import sys
 import logging
 import subprocess
 import shutil
-from processors import hplc, fplc, experiment, core
+from processors import hplc, fplc, experiment, core, downsample
 from processors.database import Database, Config
 
 def main(args):
-    file_list = core.get_files(args.files)
+    try:
+        file_list = core.get_files(args.files, args.unknown_files)
+    except ValueError as e:
+        logging.error(e)
+        sys.exit(1)
     logging.debug(file_list)
 
     # Make Experiment ------------------------------------------------------------
@@ -17,7 +21,17 @@ def main(args):
     
     
     if file_list['waters']:
-        waters, wat_sample_set = hplc.append_waters(file_list['waters'], args.hplc_flow_rate)
+        try:
+            waters, wat_sample_set, waters_runs = hplc.append_waters(
+                file_list['waters'],
+                args.hplc_flow_rate,
+                args.jobs,
+                args.default_flow_rate,
+                args.flow_rate_fallback == 'ask'
+            )
+        except ValueError as e:
+            logging.error(e)
+            sys.exit(1)
         if wat_sample_set is None:
             wat_sample_set = input('Sample set name: ')
 
@@ -26,6 +40,7 @@ def main(args):
         except NameError:
             exp = experiment.Experiment(wat_sample_set)
             exp.hplc = waters
+        exp.runs.extend(waters_runs)
 
     if file_list['shimadzu']:
         channel_mapping = {}
@@ -34,16 +49,28 @@ def main(args):
             channel_mapping[args.channel_mapping[i]] = args.channel_mapping[i+1]
             i += 2
 
-        shim, shim_sample_set = hplc.append_shim(file_list['shimadzu'], channel_mapping, args.hplc_flow_rate)
+        try:
+            shim, shim_sample_set, shim_runs = hplc.append_shim(
+                file_list['shimadzu'],
+                channel_mapping,
+                args.hplc_flow_rate,
+                args.jobs,
+                args.default_flow_rate,
+                args.flow_rate_fallback == 'ask'
+            )
+        except ValueError as e:
+            logging.error(e)
+            sys.exit(1)
 
         try:
             exp.extend_hplc(shim)
         except NameError:
             exp = experiment.Experiment(shim_sample_set)
             exp.hplc = shim
+        exp.runs.extend(shim_runs)
 
     if file_list['akta']:
-        fplc_trace = fplc.append_fplc(file_list['akta'], args.fplc_cv)
+        fplc_trace = fplc.append_fplc(file_list['akta'], args.fplc_cv, args.jobs)
         # everything but the '.csv' at the end from the first file name without directory info
         fplc_id = os.path.split(file_list['akta'][0])[1][:-4]
 
@@ -54,7 +81,7 @@ def main(args):
             exp.fplc = fplc_trace
             
     if file_list['agilent']:
-        agil = hplc.append_agilent(file_list['agilent'], args.hplc_flow_rate)
+        agil, agil_runs = hplc.append_agilent(file_list['agilent'], args.hplc_flow_rate, jobs = args.jobs)
 
         try:
             exp.extend_hplc(agil)
@@ -62,6 +89,7 @@ def main(args):
             sample_set_name = input('Please provide an experiment name')
             exp = experiment.Experiment(sample_set_name)
             exp.hplc = agil
+        exp.runs.extend(agil_runs)
 
     try:
         logging.info(f'Made {exp}')
@@ -133,12 +161,12 @@ def main(args):
             subprocess.run(fplc_command, cwd = out_dir)
 
     if args.copy_manual:
-        if exp.hplc is not None:
+        if exp.wide_hplc is not None:
             shutil.copyfile(
                 os.path.join(script_location, 'plotters', 'manual_plot_HPLC.R'),
                 os.path.join(out_dir, f'{exp.id}_manual-plot-HPLC.R')
             )
-        if exp.fplc is not None:
+        if exp.wide_fplc is not None:
             shutil.copyfile(
                 os.path.join(script_location, 'plotters', 'manual_plot_FPLC.R'),
                 os.path.join(out_dir, f'{exp.id}_manual-plot-FPLC.R')
@@ -147,8 +175,11 @@ def main(args):
     if args.config:
         db = Database(Config(args.config))
 
-        exp.reduce_hplc(args.reduce)
-        db.upload_experiment(exp, args.overwrite)
+        try:
+            db.upload_experiment(exp, args.overwrite, args.reduce, args.reduce_method, args.levels, args.merge)
+        except ValueError as e:
+            logging.error(e)
+            sys.exit(1)
 
     if args.post_to_slack:
         config = Config(args.post_to_slack)
@@ -189,10 +220,23 @@ parser.add_argument(
 )
 parser.add_argument(
     '-r', '--reduce',
-    help = 'Reduce web HPLC data points to this many total. Default 1000. CSV files are saved at full temporal resolution regardless.',
+    help = 'Points per trace in the HPLC data saved in the database document itself. Default 1000. CSV files are saved at full temporal resolution regardless.',
     type = int,
     default = 1000
 )
+parser.add_argument(
+    '--levels',
+    help = 'Also store the HPLC data reduced to each of these numbers of points, so the web viewer can load more detail as you zoom. Full resolution data is always stored. Default 10000 2000 500.',
+    type = int,
+    nargs = '+',
+    default = [10000, 2000, 500]
+)
+parser.add_argument(
+    '--reduce-method',
+    help = 'How to pick the points kept by --reduce: stride (every nth point), minmax (lowest and highest point per bucket) or lttb (largest triangle three buckets). Default lttb.',
+    choices = list(downsample.methods),
+    default = 'lttb'
+)
 parser.add_argument(
     '-d', '--database',
     help = 'Upload experiment to couchdb. Optionally, provide config file location. Default config location is "config.json" in appia directory.',
@@ -200,11 +244,34 @@ parser.add_argument(
     nargs = '?',
     const = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'config.json')
 )
+parser.add_argument(
+    '--unknown-files',
+    help = 'What to do with files whose type cannot be determined: ask, skip, fail, or treat them as the given type. Default ask.',
+    choices = ['ask', 'skip', 'fail'] + list(core.formats),
+    default = 'ask'
+)
+parser.add_argument(
+    '-j', '--jobs',
+    help = 'Number of processes to use when reading data files. Default 1.',
+    type = int,
+    default = 1
+)
 parser.add_argument(
     '--hplc-flow-rate',
     help = 'Manually override flow rate. Provide a single number in mL/min',
     type = float
 )
+parser.add_argument(
+    '--default-flow-rate',
+    help = 'Flow rate in mL/min for HPLC files whose method is not in flow_rates.json',
+    type = float
+)
+parser.add_argument(
+    '--flow-rate-fallback',
+    help = 'What to do when no flow rate can be found and there is no default: ask or fail. Default ask.',
+    choices = ['ask', 'fail'],
+    default = 'ask'
+)
 parser.add_argument(
     '--fplc-cv',
     help = 'Column volume for FPLC data. Default is 24 mL (GE/Cytiva 10/300 column).',
@@ -213,9 +280,15 @@ parser.add_argument(
 )
 parser.add_argument(
     '--overwrite',
-    help = 'Overwrite database copy of experiment with same name without asking',
+    help = 'Replace the database copy of an experiment with the same name',
     action = 'store_true'
 )
+parser.add_argument(
+    '--merge',
+    help = 'When adding to an experiment already in the database, what to do with samples it already has: update them with the new data, keep the stored data, or fail. Samples the database does not have yet are always added. Default keep.',
+    choices = ['update', 'keep', 'fail'],
+    default = 'keep'
+)
 parser.add_argument(
     '-n', '--normalize',
     help = 'Set maximum of this range (in mL) to 1',
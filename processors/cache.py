@@ -0,0 +1,113 @@
+import threading
+import logging
+from collections import OrderedDict
+
+def table_bytes(df):
+    if df is None:
+        return 0
+
+    return int(df.memory_usage(index = True, deep = True).sum())
+
+class LRUCache:
+    # Values kept in memory with their size in bytes. The least recently used
+    # are evicted once they take up more than max_bytes. Subclasses size and
+    # copy values in get and put; the bookkeeping is all here.
+    def __init__(self, max_bytes) -> None:
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def lookup(self, key):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+
+            return self.entries[key][0]
+
+    def store(self, key, value, size):
+        # Storing a key again (two threads missing on it at once) replaces
+        # the old value
+        if size > self.max_bytes:
+            return False
+
+        with self.lock:
+            self.discard(key)
+            self.before_store(key)
+
+            self.entries[key] = (value, size)
+            self.size += size
+
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self.entries.popitem(last = False)
+                self.size -= evicted
+
+        return True
+
+    def before_store(self, key):
+        # called with the lock held, before key is stored
+        pass
+
+    def discard(self, key):
+        # call with the lock held
+        if key in self.entries:
+            self.size -= self.entries.pop(key)[1]
+
+class ExperimentCache(LRUCache):
+    # Pulled experiments kept in memory, keyed by (document id, revision,
+    # hplc level). Uploading an experiment changes its revision, so stale
+    # entries are never returned, and they are dropped as soon as a newer
+    # revision is cached. The least recently used experiments are evicted
+    # once their tables take up more than max_bytes. Experiments are handed
+    # out as copies so callers can rename or relabel them freely.
+    def __init__(self, max_bytes = 512 * 2**20) -> None:
+        super().__init__(max_bytes)
+
+    def __repr__(self) -> str:
+        return f'ExperimentCache with {len(self.entries)} experiments ({self.size/2**20:.1f} of {self.max_bytes/2**20:.0f} MB)'
+
+    def get(self, key):
+        exp = self.lookup(key)
+        if exp is not None:
+            return exp.copy()
+
+    def put(self, key, exp):
+        size = table_bytes(exp.wide_hplc) + table_bytes(exp.wide_fplc)
+        if not self.store(key, exp.copy(), size):
+            logging.debug(f'{exp} is too large to cache')
+
+    def before_store(self, key):
+        self.drop(key[0], keep_rev = key[1])
+
+    def invalidate(self, id):
+        with self.lock:
+            self.drop(id)
+
+    def drop(self, id, keep_rev = None):
+        # call with the lock held
+        for key in [x for x in self.entries if x[0] == id and x[1] != keep_rev]:
+            self.discard(key)
+
+class FigureCache(LRUCache):
+    # Serialized figures kept in memory, keyed by whatever they were drawn
+    # from. Keys should include the revision of each experiment, so a new
+    # upload is drawn afresh. The least recently used figures are evicted
+    # once their JSON takes up more than max_bytes.
+    def __init__(self, max_bytes = 128 * 2**20) -> None:
+        super().__init__(max_bytes)
+
+    def __repr__(self) -> str:
+        return f'FigureCache with {len(self.entries)} figure sets ({self.size/2**20:.1f} of {self.max_bytes/2**20:.0f} MB)'
+
+    def get(self, key):
+        return self.lookup(key)
+
+    def put(self, key, figures):
+        # figures is {name: figure JSON}
+        self.store(key, figures, sum(len(x) for x in figures.values()))
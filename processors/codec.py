@@ -0,0 +1,102 @@
+import io
+import numpy as np
+import pandas as pd
+from .downsample import positions_in_trace
+
+# Binary storage for Experiment tables: one compressed NumPy archive per
+# table, with each column stored as its own array. Categorical columns are
+# stored as integer codes plus their categories, so labels are only written
+# once. Bump codec_version if the layout changes and keep decoding old ones.
+#
+# Version 2: axes of evenly sampled traces (Waters and Shimadzu times) are
+# stored as a start and step per trace instead of every value.
+codec_version = 2
+
+# A trace is on a regular grid if every point is within this fraction of a
+# step of start + step * i. That is well below the float32 rounding of the
+# stored axes.
+grid_tolerance = 1e-3
+
+def trace_segments(df, by):
+    # start and length of each trace, if each is one block of rows
+    if not by:
+        return None
+
+    codes = df.groupby(by, observed = True, sort = False).ngroup().to_numpy()
+    if codes.shape[0] == 0 or codes[0] != 0 or np.any(np.diff(codes) < 0):
+        return None
+
+    sizes = np.bincount(codes)
+    return np.cumsum(sizes) - sizes, sizes
+
+def grid(x, starts, sizes):
+    # the start and step of each trace if every trace is evenly spaced
+    if np.any(sizes < 2):
+        return None
+
+    x = x.astype(np.float64)
+    first = x[starts]
+    step = (x[starts + sizes - 1] - first) / (sizes - 1)
+
+    predicted = np.repeat(first, sizes) + np.repeat(step, sizes) * positions_in_trace(starts, sizes)
+    if np.all(np.abs(predicted - x) <= np.abs(np.repeat(step, sizes)) * grid_tolerance):
+        return first, step
+
+def encode_table(df, by = (), axes = ()):
+    # Columns in axes are checked for regular sampling within each trace,
+    # where traces are groups of the columns in by.
+    arrays = {
+        '__codec__': np.array([codec_version]),
+        '__columns__': np.array([str(x) for x in df.columns])
+    }
+
+    segments = trace_segments(df, list(by))
+    if segments is not None:
+        arrays['__sizes__'] = segments[1]
+
+    for i, column in enumerate(df.columns):
+        values = df[column]
+        regular = grid(values.to_numpy(), *segments) if column in axes and segments is not None else None
+
+        if regular is not None:
+            arrays[f'{i}.start'], arrays[f'{i}.step'] = regular
+            arrays[f'{i}.dtype'] = np.array(str(values.dtype))
+        elif isinstance(values.dtype, pd.CategoricalDtype):
+            arrays[f'{i}.codes'] = values.cat.codes.to_numpy()
+            arrays[f'{i}.categories'] = values.cat.categories.astype(str).to_numpy(dtype = str)
+        elif values.dtype == object:
+            arrays[f'{i}'] = values.astype(str).to_numpy(dtype = str)
+        else:
+            arrays[f'{i}'] = values.to_numpy()
+
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, **arrays)
+
+    return buffer.getvalue()
+
+def decode_table(data):
+    if not isinstance(data, (bytes, bytearray)):
+        data = data.read()
+
+    with np.load(io.BytesIO(data), allow_pickle = False) as arrays:
+        if int(arrays['__codec__'][0]) > codec_version:
+            raise ValueError(f'Table was written by a newer codec (version {int(arrays["__codec__"][0])})')
+
+        columns = {}
+        for i, column in enumerate(arrays['__columns__']):
+            if f'{i}.start' in arrays:
+                sizes = arrays['__sizes__']
+                starts = np.cumsum(sizes) - sizes
+                columns[str(column)] = (
+                    np.repeat(arrays[f'{i}.start'], sizes) +
+                    np.repeat(arrays[f'{i}.step'], sizes) * positions_in_trace(starts, sizes)
+                ).astype(str(arrays[f'{i}.dtype']))
+            elif f'{i}.codes' in arrays:
+                columns[str(column)] = pd.Categorical.from_codes(
+                    arrays[f'{i}.codes'],
+                    categories = arrays[f'{i}.categories']
+                )
+            else:
+                columns[str(column)] = arrays[f'{i}']
+
+    return pd.DataFrame(columns)
@@ -2,6 +2,10 @@ from math import floor
 from glob import glob
 import logging
 import os
+import io
+import codecs
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 def loading_bar(current, total, extension = '', force = False):
     try:
@@ -21,7 +25,85 @@ def loading_bar(current, total, extension = '', force = False):
         if current == total:
             print()
 
-def get_files(globs):
+def decode_utf16(file):
+    # AKTA and Agilent exports are UTF-16, which only the slow python engine
+    # in read_csv can stream. Decoding the whole file at once lets the C
+    # parser handle the text instead.
+    with open(file, 'rb') as f:
+        return io.StringIO(f.read().decode('utf-16'))
+
+def read_files(reader, file_list, jobs = 1, extension = '', args = ()):
+    # Parse each file with reader(file, *args), fanning out to a process pool
+    # when more than one job is requested. Results are returned in the same
+    # order as file_list regardless of which worker finishes first.
+    results = [None] * len(file_list)
+
+    if jobs is None or jobs <= 1 or len(file_list) <= 1:
+        for i in range(len(file_list)):
+            results[i] = reader(file_list[i], *args)
+            loading_bar(i+1, len(file_list), extension = extension)
+
+        return results
+
+    with ProcessPoolExecutor(max_workers = min(jobs, len(file_list))) as pool:
+        futures = {pool.submit(reader, file_list[i], *args): i for i in range(len(file_list))}
+
+        for finished, future in enumerate(as_completed(futures)):
+            results[futures[future]] = future.result()
+            loading_bar(finished + 1, len(file_list), extension = extension)
+
+    return results
+
+# File formats get_files can classify, in the order they are reported. Each
+# instrument module registers its own format(s) with register_format.
+formats = {}
+
+def register_format(name, extensions, sniffer = None):
+    # sniffer gets the first line of a file with a matching extension and
+    # returns True if the file is this format. Formats without a sniffer match
+    # on extension alone.
+    formats[name] = {
+        'extensions': tuple(x.lower() for x in extensions),
+        'sniffer': sniffer
+    }
+
+def first_line(file):
+    with open(file, 'rb') as f:
+        start = f.read(2048)
+
+    if start[:2] in (codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE):
+        text = start.decode('utf-16', errors = 'ignore')
+    else:
+        text = start.decode('utf-8', errors = 'ignore').replace('\x00', '')
+
+    lines = text.splitlines()
+    return lines[0].strip() if lines else ''
+
+def sniff_format(file):
+    extension = os.path.splitext(file)[1].lower()
+    candidates = [x for x in formats if extension in formats[x]['extensions']]
+
+    if not candidates:
+        return None
+
+    line = None
+    for candidate in candidates:
+        sniffer = formats[candidate]['sniffer']
+        if sniffer is None:
+            return candidate
+
+        if line is None:
+            line = first_line(file)
+        if sniffer(line):
+            logging.debug(f'{file} is a {candidate} file')
+            return candidate
+
+    return None
+
+def get_files(globs, unknown = 'ask'):
+    # unknown decides what happens to files with a known extension whose
+    # contents don't match any format: 'ask', 'skip', 'fail', or the name of
+    # a format to file them under
     globbed_files = []
     
     if isinstance(globs, str):
@@ -32,60 +114,68 @@ def get_files(globs):
 
     logging.debug(f'Globbed files: {globbed_files}')
     files = [os.path.abspath(x) for x in globbed_files]
-    arw = [x for x in files if x.endswith('.arw')]
-    asc = [x for x in files if x.endswith('.asc')]
-    csv = [x for x in files if x.endswith('.csv') or x.endswith('.CSV')]
 
-    agilent = []
-    akta = []
+    sorted_files = {x: [] for x in formats}
 
-    for file in csv:
-        # process out csvs for agil and for akta
-        with open(file, 'r') as f:
-            first_line = f.readline().strip()
+    for file in files:
+        extension = os.path.splitext(file)[1].lower()
+        if not any(extension in formats[x]['extensions'] for x in formats):
+            continue
 
-            first_cell = first_line.split()[0].replace('ÿþ', '').replace('\x00', '')
-            logging.debug(f'{file} first cell is {first_cell}')
+        file_format = sniff_format(file)
 
-            # AKTA files all have headers that say 'Chrom.1'
-            if first_cell == 'Chrom.1':
-                akta.append(file)
-                logging.debug(f'{file} is an AKTA file')
+        if file_format is None:
+            if unknown == 'fail':
+                raise ValueError(f'Could not determine filetype for {file}')
+            elif unknown == 'skip':
+                logging.warning(f'Could not determine filetype for {file}. Skipping it.')
+            elif unknown == 'ask':
+                options = ', '.join(formats)
+                response = input(f'Could not determine filetype for {file}. Type one of {options}, or anything else to skip\n').lower()
+                file_format = response if response in formats else None
             else:
-                try:
-                    # if we can make a float from the first cell, it's an Agilent file
-                    float(first_cell)
-                    agilent.append(file)
-                    logging.debug(f'{file} is an Agilent file')
-                except ValueError:
-                    response = input(f'Could not determine filetype for {file}. (A)kta, A(g)ilent, or (S)kip?\n').lower()
-                    
-                    if response == 'a':
-                        akta.append(file)
-                    elif response == 'g':
-                        agilent.append(file)      
-
-    return {
-        'waters': arw,
-        'shimadzu': asc,
-        'agilent': agilent,
-        'akta': akta
-    }
+                file_format = unknown
+
+        if file_format is not None:
+            sorted_files[file_format].append(file)
+
+    return sorted_files
+
+def concat_chroms(frames, columns):
+    # Build the table once from every per-file frame. Growing a frame
+    # file-by-file copies everything read so far on each file, which is
+    # quadratic in the number of files.
+    frames = [x for x in frames if x is not None and x.shape[0] > 0]
+
+    if not frames:
+        return pd.DataFrame(columns = columns)
+
+    return pd.concat(frames, ignore_index = True, sort = False)[columns]
+
+def normalize(df, by, norm_range = None, strict = False):
+    # Normalize Signal to 0-1 within each group in a single pass. The maximum
+    # (and with strict, the minimum) only considers points inside norm_range,
+    # which defaults to 0.5 mL up to the end of each group.
+
+    # hash the group labels once, then every reduction groups by integer codes
+    groups = df.groupby(by, observed = True, sort = False).ngroup().to_numpy()
 
-def normalizer(df, norm_range = None, strict = False):
     if not norm_range:
-        norm_range = [0.5, df.mL.max()]
+        low = 0.5
+        high = df['mL'].groupby(groups).transform('max')
+    else:
+        low = min(norm_range)
+        high = max(norm_range)
 
-    ranged_df = df.loc[(df.mL > min(norm_range)) & (df.mL < max(norm_range))]
+    ranged_sig = df['Signal'].where((df['mL'] > low) & (df['mL'] < high))
+
+    max_sig = ranged_sig.groupby(groups).transform('max')
     if strict:
-        min_sig = ranged_df.Signal.min()
+        min_sig = ranged_sig.groupby(groups).transform('min')
     else:
-        min_sig = df.Signal.min()
-
-    max_sig = ranged_df.Signal.max()
+        min_sig = df['Signal'].groupby(groups).transform('min')
 
-    df['Normalized'] = (df.Signal - min_sig)/(max_sig - min_sig)
-    df.Normalized = df.Normalized.fillna(0)
+    df['Normalized'] = ((df['Signal'] - min_sig)/(max_sig - min_sig)).fillna(0)
 
     return df
 
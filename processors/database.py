@@ -1,18 +1,144 @@
-import couchdb
 import logging
 import pandas as pd
 import os
 from .experiment import Experiment
 from .core import three_column_print
+from .codec import encode_table, decode_table
+from .index import ExperimentIndex
+from .storage import open_store, NotFound, Conflict
 import json
+from datetime import datetime, timezone
+from math import ceil
+from uuid import uuid4
+import io
+from base64 import b64encode
+from concurrent.futures import ThreadPoolExecutor
+
+# Times upload_experiment starts again when another upload changes the
+# experiment at the same time
+conflict_retries = 3
+
+# Ask pull_experiment for this many points to get the full resolution data
+FULL = float('inf')
+
+def pick_level(levels, points):
+    # coarsest level with at least this many points per trace
+    enough = [x for x in levels if x >= points]
+    return min(enough) if enough else FULL
+
+def points_for_view(points, extent, view_range):
+    # points across the whole trace needed to show `points` in the view
+    if view_range is None or extent is None:
+        return points
+
+    view_width = abs(view_range[1] - view_range[0])
+    if view_width == 0:
+        return FULL
+
+    return ceil(points * max(1, (extent[1] - extent[0])/view_width))
+
+def table_summary(df):
+    # what a document records about each table it stores
+    return {
+        'samples': sorted({str(x) for x in df['Sample'].unique()}),
+        'channels': sorted({str(x) for x in df['Channel'].unique()}),
+        'rows': len(df)
+    }
+
+def describe(doc):
+    # Fill in the searchable summary of an experiment document from its
+    # stored tables and runs
+    tables = list(doc['hplc_parts'].values())
+    if 'fplc_table' in doc:
+        tables.append(doc['fplc_table'])
+
+    doc['instruments'] = (['HPLC'] if doc['hplc_parts'] else []) + (['FPLC'] if 'fplc_table' in doc else [])
+    doc['samples'] = sorted({x for table in tables for x in table['samples']})
+    doc['channels'] = sorted({x for table in tables for x in table['channels']})
+    doc['set_names'] = sorted({x['set_name'] for x in doc['runs'] if x['set_name']})
+    doc['methods'] = sorted({x['method'] for x in doc['runs'] if x['method']})
+    doc['hplc_points'] = sum(x['rows'] for x in doc['hplc_parts'].values())
+    doc['fplc_points'] = doc['fplc_table']['rows'] if 'fplc_table' in doc else 0
+
+    if doc['hplc_parts']:
+        doc['hplc_extent'] = {
+            x: [
+                min(part['extent'][x][0] for part in doc['hplc_parts'].values()),
+                max(part['extent'][x][1] for part in doc['hplc_parts'].values())
+            ] for x in ['mL', 'Time']
+        }
+    else:
+        doc.pop('hplc_extent', None)
+
+def hplc_attachments(doc, level):
+    # Attachments holding the hplc data at a level. Version 5 documents store
+    # each upload's samples as a part with its own pyramid, and use the full
+    # data for levels at least as long as its traces. Version 4 documents
+    # have one attachment per level, the longest being the full data.
+    if 'hplc_parts' not in doc:
+        if level == FULL:
+            level = max(doc['hplc_levels'])
+        return [f'hplc-{level}.npz']
+
+    return [
+        f'hplc-{level}-{part}.npz' if level < info['points'] else f'hplc-full-{part}.npz'
+        for part, info in doc['hplc_parts'].items()
+    ]
+
+# Optional CouchDB connection settings (see CouchStore), from the config or
+# $COUCHDB_POOL_SIZE, $COUCHDB_CONNECT_TIMEOUT...
+couch_settings = {
+    'pool_size': int,
+    'connect_timeout': float,
+    'read_timeout': float,
+    'retries': int
+}
+
+def drop_samples(doc, part, samples):
+    # Replaced samples are only taken out of the part's summary, so updating
+    # them uploads nothing but the new data. Their rows stay in the part's
+    # attachments and are filtered out on load (see part_samples), until the
+    # part has no samples left and is removed.
+    info = doc['hplc_parts'][part]
+    dropped = set(info['samples']) & set(samples)
+
+    info['samples'] = [x for x in info['samples'] if x not in dropped]
+    info['dropped'] = sorted(set(info.get('dropped', [])) | dropped)
+    if 'sample_rows' in info:
+        info['rows'] -= sum(info['sample_rows'].pop(x, 0) for x in dropped)
+
+    if not info['samples']:
+        del doc['hplc_parts'][part]
+        for name in [x for x in doc['_attachments'] if x.endswith(f'-{part}.npz')]:
+            del doc['_attachments'][name]
+
+def part_samples(doc, names):
+    # The samples to keep from each of the hplc attachments in names (as
+    # given by hplc_attachments), or None to keep all of them
+    if 'hplc_parts' not in doc:
+        return [None for x in names]
+
+    return [info['samples'] if info.get('dropped') else None for info in doc['hplc_parts'].values()]
 
 class Config:
     def __init__(self, config_file = None) -> None:
+        # A local SQLite file can stand in for CouchDB, from $APPIA_SQLITE or
+        # the config's "sqlite" path (relative to the config file)
+        self.sqlite = None
+        self.chost = None
 
         if config_file is None:
-            self.cuser = os.environ['COUCHDB_USER']
-            self.cpass = os.environ['COUCHDB_PASSWORD']
-            self.chost = os.environ['COUCHDB_HOST']
+            if 'APPIA_SQLITE' in os.environ:
+                self.sqlite = os.environ['APPIA_SQLITE']
+            else:
+                self.cuser = os.environ['COUCHDB_USER']
+                self.cpass = os.environ['COUCHDB_PASSWORD']
+                self.chost = os.environ['COUCHDB_HOST']
+
+            self.couch_options = {
+                name: kind(os.environ[f'COUCHDB_{name.upper()}'])
+                for name, kind in couch_settings.items() if f'COUCHDB_{name.upper()}' in os.environ
+            }
         else:
             with open(config_file) as conf:
                 config = json.load(conf)
@@ -23,8 +149,14 @@ class Config:
                 self.chost = config['host']
                 self.couch = True
             except KeyError:
-                logging.warning('Config missing information to connect to CouchDB')
                 self.couch = False
+                if 'sqlite' not in config:
+                    logging.warning('Config missing information to connect to CouchDB')
+
+            if 'sqlite' in config:
+                self.sqlite = os.path.join(os.path.dirname(config_file), os.path.expanduser(config['sqlite']))
+
+            self.couch_options = {name: kind(config[name]) for name, kind in couch_settings.items() if name in config}
             
             try:
                 self.slack_token = config['token']
@@ -35,96 +167,374 @@ class Config:
                 self.slack = False
 
     def __repr__(self) -> str:
-        return f'config object for host {self.chost}'
+        return f'config object for {self.sqlite or self.chost}'
 
 class Database:
-    def __init__(self, config) -> None:
+    def __init__(self, config, cache = None) -> None:
+        # cache is an optional ExperimentCache for pulled experiments
         self.config = config
-        self.version = 3
-        couchserver = couchdb.Server(f'http://{config.cuser}:{config.cpass}@{config.chost}:5984')
-
-        dbname = 'traces'
-        if dbname in couchserver:
-            self.db = couchserver[dbname]
-        else:
-            self.db = couchserver.create(dbname)
+        self.cache = cache
+        self.version = 5
+        self.store = open_store(config)
+        self.index = ExperimentIndex(self.store)
 
     def __repr__(self) -> str:
-        return f'CouchDB at {self.config.chost}'
+        return repr(self.store)
+
+    def metrics(self):
+        # request latencies of the store and use of the experiment cache
+        metrics = {'store': repr(self.store)}
+
+        if hasattr(self.store, 'stats'):
+            metrics['requests'] = self.store.stats.summary()
+            metrics['connections_opened'] = self.store.session.connection_pool.opened
+
+        if self.cache is not None:
+            metrics['cache'] = {
+                'experiments': len(self.cache.entries),
+                'bytes': self.cache.size,
+                'hits': self.cache.hits,
+                'misses': self.cache.misses
+            }
+
+        return metrics
+
+    def search_experiments(self, term, fields = None, limit = 1000):
+        # Experiments with an id containing term, or a value starting with
+        # it, as {id: [(field, value)]}. fields limits which fields are
+        # searched, out of experiment, sample, channel, set_name and method.
+        # Only the ids of experiments from before version 4 are searchable.
+        term = term.strip().lower()
+        if not term:
+            return {}
+
+        results = {}
+        if fields is None or 'experiment' in fields:
+            if self.index.entries is None:
+                self.index.refresh()
+            results = {x: [] for x in self.index.entries if term in x.lower()}
+
+        for id, field, value in self.store.search(term, limit):
+            if fields is None or field in fields:
+                results.setdefault(id, []).append((field, value))
+
+        return results
 
     def update_experiment_list(self):
-        return [x['id'] for x in self.db.view('_all_docs')]
+        self.index.refresh()
+        return sorted(self.index.entries)
+
 
+    def choose_level(self, doc, points, view_range, x_ax):
+        # The coarsest stored level of the hplc pyramid that still has
+        # `points` points inside view_range (or the whole trace). Without
+        # points, the level picked at upload.
+        if points is None and 'hplc_default' in doc:
+            return doc['hplc_default']
+
+        extent = doc.get('hplc_extent', {}).get(x_ax)
+        level = pick_level(doc['hplc_levels'], points_for_view(points, extent, view_range))
+        logging.debug(f'Pulling {level} point level of {doc["_id"]}')
+
+        return level
+
+    def pull_experiment(self, id, points = None, view_range = None, x_ax = 'mL'):
+        # The document only holds metadata, so fetching it is cheap and gives
+        # the current revision to check the cache against
+        return self.experiment_from_doc(self.store.get(id), points, view_range, x_ax)
+
+    def experiment_key(self, doc, points = None, view_range = None, x_ax = 'mL'):
+        # (id, revision, hplc level) of what experiment_from_doc would load,
+        # so callers can tell if anything changed without loading it
+        legacy = doc.get('version', 0) < 4
+
+        if doc.get('hplc_levels') and (points is not None or not legacy):
+            level = self.choose_level(doc, points, view_range, x_ax)
+        else:
+            level = None
 
-    def pull_experiment(self, id):
-        doc = self.db.get(id)
-        new_exp = Experiment(id)
+        return doc['_id'], doc['_rev'], level
 
+    def experiment_from_doc(self, doc, points = None, view_range = None, x_ax = 'mL'):
         try:
-            new_exp.hplc = pd.read_json(doc['hplc'])
-        except ValueError:
-            pass
+            legacy = doc['version'] < 4
+            if doc['version'] > self.version:
+                logging.error('Experiment is newer than this version of appia. Please update.')
+        except KeyError:
+            logging.error('No version number. Check experiment ID and perform db migration.')
+            legacy = True
+
+        key = self.experiment_key(doc, points, view_range, x_ax)
+        level = key[2]
+        if self.cache is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
+
+        if legacy:
+            new_exp = self.pull_json_experiment(doc, level)
+        else:
+            new_exp = self.load_experiment(doc, level)
+
+        if self.cache is not None:
+            self.cache.put(key, new_exp)
+
+        return new_exp
+
+    def load_experiment(self, doc, level):
+        new_exp = Experiment(doc['_id'])
+        new_exp.runs = doc.get('runs', [])
+
+        if level is not None and doc.get('hplc_levels'):
+            names = hplc_attachments(doc, level)
+            tables = []
+            for name, samples in zip(names, part_samples(doc, names)):
+                table = decode_table(self.store.get_attachment(doc['_id'], name))
+                if samples is not None:
+                    table = table[table['Sample'].astype(str).isin(samples)]
+                    table = table.assign(Sample = table['Sample'].cat.remove_unused_categories())
+                tables.append(table)
+
+            if tables:
+                new_exp.hplc = pd.concat(tables, ignore_index = True)
+
+        if 'fplc_table' in doc or doc.get('fplc_points'):
+            new_exp.fplc = decode_table(self.store.get_attachment(doc['_id'], 'fplc.npz'))
+
+        return new_exp
+
+    def pull_json_experiment(self, doc, level = None):
+        # Version 2 and 3 documents hold their tables as DataFrame.to_json
+        # strings. Some version 3 documents also have JSON pyramid levels
+        # attached.
+        logging.info(f'Reading version {doc.get("version")} experiment. Run appia database --migrate to convert it.')
+        new_exp = Experiment(doc['_id'])
+
+        if level is not None:
+            if level == FULL:
+                level = max(doc['hplc_levels'])
+            new_exp.hplc = pd.read_json(
+                io.BytesIO(self.store.get_attachment(doc['_id'], f'hplc-{level}.json')),
+                orient = 'split'
+            )
+        else:
+            try:
+                new_exp.hplc = pd.read_json(doc['hplc'])
+            except ValueError:
+                pass
 
         try:
             new_exp.fplc = pd.read_json(doc['fplc'])
         except ValueError:
             pass
 
-        try:
-            if doc['version'] == 2:
-                logging.info('Upgrading from Experiment v2')
-            elif doc['version'] != self.version:
-                logging.error('Out of date experiment. Perform db migration.')
-        except KeyError:
-            logging.error('No version number. Check experiment ID and perform db migration.')
-
         return new_exp
 
+    def get_docs(self, ids):
+        # documents for ids in one request, None for any that don't exist
+        docs = self.store.get_many(ids)
+        for id, doc in zip(ids, docs):
+            if doc is None:
+                logging.error(f'Could not find experiment {id}')
+
+        return docs
+
+    def experiments_from_docs(self, docs, points = None, view_range = None, x_ax = 'mL', jobs = 8):
+        # experiment_from_doc for each document, jobs at a time
+        with ThreadPoolExecutor(max_workers = jobs) as pool:
+            return list(pool.map(lambda doc: self.experiment_from_doc(doc, points, view_range, x_ax), docs))
+
+    def pull_experiments(self, ids, points = None, view_range = None, x_ax = 'mL', jobs = 8, batch_size = 50):
+        # Pull many experiments, in order. Documents are fetched batch_size at
+        # a time in one request each, and their attachments fetched and
+        # decoded by jobs threads. Experiments that don't exist are skipped.
+        with ThreadPoolExecutor(max_workers = jobs) as pool:
+            for i in range(0, len(ids), batch_size):
+                docs = [x for x in self.get_docs(ids[i:i + batch_size]) if x is not None]
+                yield from pool.map(lambda doc: self.experiment_from_doc(doc, points, view_range, x_ax), docs)
+
+    def save_docs(self, docs, batch_size = 100):
+        # Write documents batch_size at a time through _bulk_docs. Returns
+        # the ids of documents that could not be saved.
+        failed = []
+        for i in range(0, len(docs), batch_size):
+            for success, id, result in self.store.bulk(docs[i:i + batch_size]):
+                if not success:
+                    logging.error(f'Could not save {id}: {result}')
+                    failed.append(id)
+
+        return failed
+
+    def remove_experiments(self, ids, batch_size = 100):
+        for i in range(0, len(ids), batch_size):
+            batch = ids[i:i + batch_size]
+            revs = self.store.revs(batch)
+
+            for id in batch:
+                if id not in revs:
+                    logging.error(f'Could not find experiment {id}')
+
+            self.save_docs([{'_id': id, '_rev': rev, '_deleted': True} for id, rev in revs.items()], batch_size)
+
     def remove_experiment(self, exp_id):
+        doc = self.store.get(exp_id)
+
         try:
-            self.db.delete(self.db[exp_id])
-        except couchdb.http.ResourceNotFound:
+            if doc is None:
+                raise NotFound(exp_id)
+            self.store.delete(exp_id, doc['_rev'])
+        except NotFound:
             logging.error(f'Could not find experiment {exp_id}')
 
-    def upload_experiment(self, exp, overwrite = False):
-        logging.info(f'Uploading {exp} to {self}')
-        doc = exp.jsonify()
+    def write_experiment(self, doc, exp, reduce, method, levels, merge = 'update', save = True):
+        # Add the tables of exp to doc and save it in place. Each upload's
+        # hplc samples are attached as a separate part, at full resolution
+        # and at each pyramid level, so adding samples to an experiment only
+        # uploads the new ones. merge decides what happens to samples that
+        # are already stored: 'update' replaces them, 'keep' keeps the stored
+        # ones and 'fail' raises a ValueError. Documents are only saved once
+        # all of their new attachments are in place. With save = False, the
+        # new attachments are put inline in doc, which is returned to be
+        # saved with save_docs.
+        doc['version'] = self.version
+        doc.setdefault('hplc_levels', sorted(set(levels) | {reduce}))
+        doc.setdefault('hplc_default', reduce)
+        doc.setdefault('hplc_parts', {})
+        doc.setdefault('runs', [])
+        doc.setdefault('_attachments', {})
 
-        try:
-            self.db.save(doc)
-        except couchdb.http.ResourceConflict:
-            if overwrite:
-                self.remove_experiment(exp.id)
-                self.db.save(doc)
-                return
+        hplc = exp.wide_hplc
+        conflicts = set()
+        if hplc is not None:
+            stored = {x for part in doc['hplc_parts'].values() for x in part['samples']}
+            conflicts = stored & set(hplc['Sample'].astype(str).unique())
 
-            logging.warning(f'Experiment "{exp.id}" already in database.')
-            old_exp = self.pull_experiment(exp.id)
-
-            merged_exp = Experiment(exp.id)
-            if exp.hplc is not None:
-                if old_exp.hplc is not None:
-                    if input('Overwrite old HPLC data? Y/N\n').lower() == 'y':
-                        merged_exp.hplc = exp.hplc
-                    else:
-                        merged_exp.hplc = old_exp.hplc
-                else:
-                    merged_exp.hplc = exp.hplc
-            else:
-                merged_exp.hplc = old_exp.hplc
-
-            if exp.fplc is not None:
-                if old_exp.fplc is not None:
-                    if input('Overwrite old FPLC data? Y/N\n').lower() == 'y':
-                        merged_exp.fplc = exp.fplc
-                    else:
-                        merged_exp.fplc = old_exp.fplc
-                else:
-                    merged_exp.fplc = exp.fplc
+        fplc_conflict = exp.wide_fplc is not None and 'fplc_table' in doc
+        if merge == 'fail' and (conflicts or fplc_conflict):
+            stored = sorted(conflicts) + (['FPLC data'] if fplc_conflict else [])
+            raise ValueError(f'Experiment "{doc["_id"]}" already has {", ".join(stored)}')
+
+        if '_rev' not in doc and save:
+            # attachments need an existing document
+            doc['_rev'] = self.store.put({'_id': doc['_id'], 'version': self.version})
+
+        if conflicts and merge == 'keep':
+            logging.warning(f'Keeping stored data for {", ".join(sorted(conflicts))}')
+            hplc = hplc[~hplc['Sample'].astype(str).isin(conflicts)]
+        elif conflicts:
+            logging.info(f'Replacing stored data for {", ".join(sorted(conflicts))}')
+            for part in [x for x, info in doc['hplc_parts'].items() if conflicts & set(info['samples'])]:
+                drop_samples(doc, part, conflicts)
+
+            doc['runs'] = [x for x in doc['runs'] if x['sample'] not in conflicts]
+
+        if hplc is not None and len(hplc):
+            self.put_hplc_part(doc, hplc, method, save)
+            added = set(hplc['Sample'].astype(str).unique())
+            doc['runs'] = doc['runs'] + [x for x in exp.runs if x['sample'] in added]
+
+        if exp.wide_fplc is not None:
+            if fplc_conflict and merge == 'keep':
+                logging.warning('Keeping stored FPLC data')
             else:
-                merged_exp.fplc = old_exp.fplc
+                self.put_table(doc, exp.wide_fplc, 'fplc.npz', ['mL', 'CV'], save)
+                doc['fplc_table'] = table_summary(exp.wide_fplc)
+
+        # attachments left by an earlier upload that failed part way through
+        keep = {'fplc.npz'} if 'fplc_table' in doc else set()
+        for name in list(doc['_attachments']):
+            if name not in keep and not any(name.endswith(f'-{part}.npz') for part in doc['hplc_parts']):
+                del doc['_attachments'][name]
+
+        describe(doc)
+        doc['uploaded'] = datetime.now(timezone.utc).isoformat(timespec = 'seconds')
+        if save:
+            self.store.put(doc)
+
+        return doc
+
+    def put_table(self, doc, table, name, axes, save = True):
+        data = encode_table(table, ['Sample', 'Channel'], axes)
+
+        if save:
+            self.store.put_attachment(doc, data, name, 'application/octet-stream')
+            doc['_attachments'][name] = {'stub': True}
+        else:
+            doc['_attachments'][name] = {
+                'content_type': 'application/octet-stream',
+                'data': b64encode(data).decode('ascii')
+            }
+
+    def put_hplc_part(self, doc, hplc, method, save = True):
+        part = uuid4().hex[:8]
 
-            self.remove_experiment(exp.id)
-            doc = merged_exp.jsonify()
-            self.db.save(doc)
+        part_exp = Experiment(doc['_id'])
+        part_exp.hplc = hplc
+        pyramid = part_exp.hplc_pyramid(doc['hplc_levels'], method)
+        points = max(pyramid)
+
+        for level, table in pyramid.items():
+            name = f'hplc-full-{part}.npz' if level == points else f'hplc-{level}-{part}.npz'
+            self.put_table(doc, table, name, ['Time', 'mL'], save)
+
+        doc['hplc_parts'][part] = dict(
+            table_summary(hplc),
+            sample_rows = {str(x): int(n) for x, n in hplc['Sample'].value_counts().items() if n},
+            points = points,
+            extent = {x: [float(hplc[x].min()), float(hplc[x].max())] for x in ['mL', 'Time']}
+        )
+
+    def migrate_experiments(self, ids = None, reduce = 1000, method = 'lttb', levels = (10000, 2000, 500), jobs = 8, batch_size = 20):
+        # Rewrite documents from older versions in the current format,
+        # batch_size at a time through _bulk_docs. Each document is replaced
+        # in place, so a failed migration leaves the old one as it was.
+        if not ids:
+            ids = [x for x, info in self.index.refresh().items() if (info['version'] or 0) < self.version]
+
+        with ThreadPoolExecutor(max_workers = jobs) as pool:
+            for i in range(0, len(ids), batch_size):
+                docs = []
+                for doc in self.get_docs(ids[i:i + batch_size]):
+                    if doc is None:
+                        continue
+                    if doc.get('version', 0) >= self.version:
+                        logging.info(f'{doc["_id"]} is already version {doc["version"]}')
+                        continue
+                    docs.append(doc)
+
+                def convert(doc):
+                    logging.info(f'Migrating {doc["_id"]} from version {doc.get("version")}')
+                    exp = self.experiment_from_doc(doc, FULL)
+                    return self.write_experiment(dict(exp.jsonify(), _rev = doc['_rev']), exp, reduce, method, levels, save = False)
+
+                self.save_docs(list(pool.map(convert, docs)), batch_size)
+
+    def upload_experiment(self, exp, overwrite = False, reduce = 1000, method = 'lttb', levels = (10000, 2000, 500), merge = 'keep'):
+        # Experiments already in the database are updated in place: only the
+        # new samples are uploaded, and merge decides what happens to samples
+        # that are already stored (see write_experiment). With overwrite, the
+        # stored experiment is replaced instead.
+        logging.info(f'Uploading {exp} to {self}')
+
+        # If another upload saves the experiment first, start again from its
+        # revision
+        for attempt in range(conflict_retries):
+            doc = self.store.get(exp.id)
+            if doc is None:
+                doc = exp.jsonify()
+            elif overwrite:
+                doc = dict(exp.jsonify(), _rev = doc['_rev'])
+            elif doc.get('version', 0) < self.version:
+                # older documents can't be added to, so store them in the
+                # current format first
+                logging.warning(f'Converting experiment "{exp.id}" to version {self.version}')
+                self.migrate_experiments([exp.id], reduce, method, levels)
+                doc = self.store.get(exp.id)
+
+            try:
+                self.write_experiment(doc, exp, reduce, method, levels, merge)
+                return
+            except Conflict:
+                logging.warning(f'Experiment "{exp.id}" was changed by another upload, trying again')
 
+        raise ValueError(f'Could not save experiment "{exp.id}", other uploads kept changing it')
@@ -0,0 +1,140 @@
+import numpy as np
+
+# Reduce every trace in a table to about num_points points. Each method works
+# on all traces (groups of `by`) at once and expects rows to already be in x
+# order within a trace. They return the positions of the rows to keep, in
+# their original order.
+
+def group_segments(df, by):
+    # Order rows so each trace is one contiguous segment, keeping the row
+    # order within traces
+    codes = df.groupby(by, observed = True, sort = False).ngroup().to_numpy()
+    order = np.argsort(codes, kind = 'stable')
+    # rows with a missing label have code -1, sort first, and are dropped
+    order = order[np.count_nonzero(codes < 0):]
+    sizes = np.bincount(codes[codes >= 0])
+    starts = np.cumsum(sizes) - sizes
+
+    return order, starts, sizes
+
+def positions_in_trace(starts, sizes):
+    return np.arange(sizes.sum()) - np.repeat(starts, sizes)
+
+def segment_ranges(lo, hi):
+    # flat positions covering [lo, hi) for each pair, plus where each range starts
+    lens = hi - lo
+    offsets = np.cumsum(lens) - lens
+    flat = np.repeat(lo, lens) + np.arange(lens.sum()) - np.repeat(offsets, lens)
+
+    return flat, offsets, lens
+
+def stride(df, by, num_points, x = None, y = None):
+    # every k-th point, where k = floor(points/num_points)
+    order, starts, sizes = group_segments(df, by)
+    step = np.maximum(1, sizes // num_points)
+
+    keep = positions_in_trace(starts, sizes) % np.repeat(step, sizes) == 0
+
+    return np.sort(order[keep])
+
+def minmax(df, by, num_points, x = None, y = 'Signal'):
+    # split each trace into num_points/2 buckets and keep the lowest and
+    # highest point of each, so narrow peaks survive
+    order, starts, sizes = group_segments(df, by)
+    ys = df[y].to_numpy()[order]
+    n_buckets = max(1, num_points // 2)
+
+    keep = [np.flatnonzero(np.repeat(sizes <= num_points, sizes))]
+
+    big_traces = sizes > num_points
+    big = np.flatnonzero(np.repeat(big_traces, sizes))
+
+    if big.shape[0]:
+        trace = np.repeat(np.arange(sizes.shape[0], dtype = np.int64), sizes)
+        bucket = positions_in_trace(starts, sizes) * n_buckets // np.repeat(sizes, sizes)
+        key = trace[big] * n_buckets + bucket[big]
+
+        # after sorting by bucket then value, the first and last row of each
+        # bucket are its lowest and highest points
+        by_value = np.lexsort((ys[big], key))
+        sorted_key = key[by_value]
+        by_value = big[by_value]
+
+        bounds = np.flatnonzero(np.diff(sorted_key)) + 1
+        keep.extend([
+            by_value[np.concatenate([[0], bounds])],
+            by_value[np.concatenate([bounds - 1, [sorted_key.shape[0] - 1]])],
+            # the ends of each trace keep its x range intact
+            starts[big_traces],
+            starts[big_traces] + sizes[big_traces] - 1
+        ])
+
+    return np.sort(order[np.unique(np.concatenate(keep))])
+
+def lttb(df, by, num_points, x = 'mL', y = 'Signal'):
+    # Largest-Triangle-Three-Buckets: keep the first and last point, and from
+    # each of num_points - 2 buckets the point making the largest triangle
+    # with the previously kept point and the average of the next bucket.
+    # Buckets are walked in order, but each step handles every trace at once.
+    num_points = max(num_points, 3)
+    order, starts, sizes = group_segments(df, by)
+    xs = df[x].to_numpy(dtype = np.float64)[order]
+    ys = df[y].to_numpy(dtype = np.float64)[order]
+
+    keep = [np.flatnonzero(np.repeat(sizes <= num_points, sizes))]
+
+    big = sizes > num_points
+    first = starts[big]
+    last = starts[big] + sizes[big] - 1
+    every = (sizes[big] - 2) / (num_points - 2)
+
+    def bucket(b):
+        lo = first + np.floor(b * every).astype(np.int64) + 1
+        hi = np.minimum(first + np.floor((b + 1) * every).astype(np.int64) + 1, last)
+        return segment_ranges(lo, hi)
+
+    if first.shape[0]:
+        keep.extend([first, last])
+
+        previous = first
+        current = bucket(0)
+        for b in range(num_points - 2):
+            flat, offsets, lens = current
+
+            if b + 1 < num_points - 2:
+                current = bucket(b + 1)
+                next_flat, next_offsets, next_lens = current
+                cx = np.add.reduceat(xs[next_flat], next_offsets) / next_lens
+                cy = np.add.reduceat(ys[next_flat], next_offsets) / next_lens
+            else:
+                cx = xs[last]
+                cy = ys[last]
+
+            ax = np.repeat(xs[previous], lens)
+            ay = np.repeat(ys[previous], lens)
+            area = np.abs(
+                (ax - np.repeat(cx, lens)) * (ys[flat] - ay) -
+                (ax - xs[flat]) * (np.repeat(cy, lens) - ay)
+            )
+            area = np.nan_to_num(area, nan = -1)
+
+            # first point with the largest area in each trace's bucket
+            hits = np.flatnonzero(area == np.repeat(np.maximum.reduceat(area, offsets), lens))
+            previous = flat[hits[np.searchsorted(hits, offsets)]]
+            keep.append(previous)
+
+    return np.sort(order[np.concatenate(keep)])
+
+methods = {
+    'stride': stride,
+    'minmax': minmax,
+    'lttb': lttb
+}
+
+def downsample(df, by, num_points, method = 'lttb', x = 'mL', y = 'Signal'):
+    if method not in methods:
+        raise ValueError(f'Unknown downsampling method {method}')
+
+    rows = methods[method](df, by, num_points, x, y)
+
+    return df.iloc[rows].reset_index(drop = True)
@@ -1,62 +1,156 @@
 import pandas as pd
+import numpy as np
+from pandas.api.types import union_categoricals
 import os
 from .core import *
-from math import floor
+from .downsample import downsample
+
+# Labels are repeated on every row, so store them as categoricals. Detector
+# signals and axes don't need more than float32.
+label_columns = ['Sample', 'Channel', 'Normalization']
+numeric_columns = ['mL', 'Time', 'CV', 'Value', 'Signal', 'Normalized']
+
+def compact(df):
+    columns = {}
+    for column in df.columns:
+        if column in label_columns and not isinstance(df[column].dtype, pd.CategoricalDtype):
+            # sample names like '12' can come back from JSON as numbers
+            columns[column] = df[column].astype(str).astype('category')
+        elif column in numeric_columns and df[column].dtype != np.float32:
+            columns[column] = df[column].astype(np.float32)
+
+    if columns:
+        df = df.assign(**columns)
+
+    return df
+
+def rename_labels(labels, mapping):
+    # Rename the categories instead of every row. Falls back to strings if two
+    # categories end up with the same name.
+    categories = [mapping.get(x, x) for x in labels.cat.categories]
+
+    if len(set(categories)) == len(categories):
+        return labels.cat.rename_categories(categories)
+
+    return labels.astype(str).replace(mapping)
+
+# Columns identifying each point. Experiments store Signal and Normalized
+# side by side with these, and only melt to the long format
+# (Normalization/Value) when asked for it.
+hplc_ids = ['mL', 'Sample', 'Channel', 'Time']
+fplc_ids = ['mL', 'CV', 'Channel', 'Fraction', 'Sample']
+
+def widen(df, ids):
+    if 'Normalization' not in df.columns:
+        return df
+
+    # this arcane string of pandas commands is the equivalent of pivot_wider from tidyverse
+    wide = df.pivot(
+        index = ids,
+        columns = 'Normalization',
+        values = 'Value'
+    ).reset_index()
+    wide.columns = [str(x) for x in wide.columns]
+
+    if 'Normalized' not in wide.columns:
+        wide['Normalized'] = np.nan
+
+    return wide
+
+def lengthen(df, ids):
+    return compact(df.melt(
+        id_vars = ids,
+        value_vars = ['Signal', 'Normalized'],
+        var_name = 'Normalization',
+        value_name = 'Value'
+    ))
 
 class Experiment:
     def __init__(self, id) -> None:
         self.id = id
-        self.version = 3
+        self.version = 5
         self._hplc = None
         self._fplc = None
+        # set name, instrument method and flow rate of each HPLC sample
+        self.runs = []
 
     @property
     def hplc(self):
-        try:
-            return self._hplc
-        except AttributeError:
+        # long format, built on request
+        if self.wide_hplc is None:
             return None
 
+        return lengthen(self.wide_hplc, hplc_ids)
+
     @hplc.setter
     def hplc(self, df):
-        if isinstance(df, pd.DataFrame) or df is None:
-            self._hplc = df
+        if df is None:
+            self._hplc = None
+        elif isinstance(df, pd.DataFrame):
+            self._hplc = compact(widen(df, hplc_ids))
         else:
             raise TypeError('HPLC input is not a pandas dataframe')
 
     @property
-    def fplc(self):
+    def wide_hplc(self):
         try:
-            return self._fplc
+            return self._hplc
         except AttributeError:
             return None
 
+    @property
+    def fplc(self):
+        # long format, built on request
+        if self.wide_fplc is None:
+            return None
+
+        return lengthen(self.wide_fplc, fplc_ids)
+
     @fplc.setter
     def fplc(self, df):
-        if isinstance(df, pd.DataFrame) or df is None:
-            self._fplc = df
+        if df is None:
+            self._fplc = None
+        elif isinstance(df, pd.DataFrame):
+            self._fplc = compact(widen(df, fplc_ids))
         else:
             raise TypeError('FPLC input is not a pandas dataframe')
 
+    @property
+    def wide_fplc(self):
+        try:
+            return self._fplc
+        except AttributeError:
+            return None
+
     def __repr__(self):
         to_return = f'Experiment "{self.id}" with '
-        if self.hplc is not None:
+        if self.wide_hplc is not None:
             to_return += 'HPLC '
-        if self.hplc is not None and self.fplc is not None:
+        if self.wide_hplc is not None and self.wide_fplc is not None:
             to_return += 'and '
-        if self.fplc is not None:
+        if self.wide_fplc is not None:
             to_return += 'FPLC '
-        if self.hplc is None and self.fplc is None:
+        if self.wide_hplc is None and self.wide_fplc is None:
             to_return += 'no '
         to_return += 'data'
 
         return to_return
 
+    def copy(self):
+        new_exp = Experiment(self.id)
+        if self.wide_hplc is not None:
+            new_exp.hplc = self.wide_hplc.copy()
+        if self.wide_fplc is not None:
+            new_exp.fplc = self.wide_fplc.copy()
+        new_exp.runs = [dict(x) for x in self.runs]
+
+        return new_exp
+
     def extend_hplc(self, hplc):
         if not isinstance(hplc, pd.DataFrame):
             raise TypeError(f'Tried to extend experiment hplc with {type(hplc)}')
 
-        self.hplc = pd.concat([self.hplc, hplc])
+        self.hplc = pd.concat([self.wide_hplc, widen(hplc, hplc_ids)])
 
     def show_tables(self):
         print('HPLC:')
@@ -65,92 +159,68 @@ class Experiment:
         print(self.fplc)
 
     def jsonify(self):
-        if self.hplc is not None:
-            hplc_json = self.hplc.to_json()
-        else:
-            hplc_json = ''
-
-        if self.fplc is not None:
-            fplc_json = self.fplc.to_json()
-        else:
-            fplc_json = ''
-
+        # Tables are stored as binary attachments and described by the
+        # database when it saves them, so this is just the start of a
+        # document
         doc = {
             '_id': self.id,
-            'version': self.version,
-            'hplc': hplc_json,
-            'fplc': fplc_json
+            'version': self.version
         }
 
         return doc
 
     def renormalize_hplc(self, norm_range, strict):
-        if self.hplc is None:
+        if self.wide_hplc is None:
             raise ValueError('No HPLC data')
 
-        # this arcane string of pandas commands is the equivalent of pivot_wider from tidyverse
-        # from https://medium.com/@durgaswaroop/reshaping-pandas-dataframes-melt-and-unmelt-9f57518c7738;.'/
-        hplc = self.hplc.pivot(
-                index = ['mL', 'Sample', 'Channel', 'Time'],
-                columns = ['Normalization']
-            )['Value'].reset_index()
-        hplc = hplc.groupby(['Sample', 'Channel']).apply(lambda x: normalizer(x, norm_range, strict))
-        hplc = hplc.melt(
-            id_vars = ['mL', 'Sample', 'Channel', 'Time'],
-            value_vars = ['Signal', 'Normalized'],
-            var_name = 'Normalization',
-            value_name = 'Value'
-        )
-        self.hplc = hplc
+        self.hplc = normalize(self.wide_hplc, ['Sample', 'Channel'], norm_range, strict)
 
     def renormalize_fplc(self, norm_range, strict):
-        if self.fplc is None:
+        if self.wide_fplc is None:
             raise ValueError('No FPLC data')
 
-        fplc = self.fplc.pivot(
-                index = ['mL', 'CV', 'Fraction', 'Channel', 'Sample'],
-                columns = ['Normalization']
-            )['Value'].reset_index()
-        fplc = fplc.groupby(['Sample', 'Channel']).apply(lambda x: normalizer(x, norm_range, strict))
-        fplc = fplc.melt(
-            id_vars = ['mL', 'CV', 'Channel', 'Fraction', 'Sample'],
-            value_vars = ['Signal', 'Normalized'],
-            var_name = 'Normalization',
-            value_name = 'Value'
-        )
-        self.fplc = fplc
-
-    def reduce_hplc(self, num_points):
-        # reduce the number of points in the hplc trace to num_points per sample/channel/norm
-
-        def reduction_factor(df, num_ponts):
-            total_points = df.shape[0]
-            reduction_factor = floor(total_points/num_points)
-            return df[::reduction_factor]
+        self.fplc = normalize(self.wide_fplc, ['Sample', 'Channel'], norm_range, strict)
 
-        try:
-            self.hplc = self.hplc.groupby(['Channel', 'Sample', 'Normalization']).apply(lambda x: reduction_factor(x, num_points))
-            self.hplc = self.hplc.reset_index(drop = True)
-        except AttributeError:
+    def reduce_hplc(self, num_points, method = 'lttb'):
+        # reduce the number of points in the hplc trace to num_points per sample/channel
+        if self.wide_hplc is None:
             return
 
+        self.hplc = downsample(self.wide_hplc, ['Channel', 'Sample'], num_points, method)
+
+    def hplc_pyramid(self, levels, method = 'lttb'):
+        # Copies of the hplc data downsampled to each number of points per
+        # trace, keyed by that number. The full data is keyed by its longest
+        # trace, and levels at least that long are left out.
+        if self.wide_hplc is None:
+            return {}
+
+        trace_points = int(self.wide_hplc.groupby(['Channel', 'Sample'], observed = True).size().max())
+        pyramid = {trace_points: self.wide_hplc}
+
+        for level in sorted(set(levels)):
+            if level < trace_points:
+                pyramid[level] = downsample(self.wide_hplc, ['Channel', 'Sample'], level, method)
+
+        return pyramid
+
     def rename_channels(self, channel_name_dict):
-        self.hplc = self.hplc.replace({'Channel': channel_name_dict})
+        hplc = self.wide_hplc
+        hplc['Channel'] = rename_labels(hplc['Channel'], channel_name_dict)
+        self.hplc = hplc
 
     def hplc_csv(self, outfile):
         if outfile[-4:] == '.csv':
             outfile = outfile[:-4]
-        if self.hplc is not None:
+        if self.wide_hplc is not None:
             self.hplc.to_csv(outfile + '-long.csv', index = False)
 
-            wide = self.hplc.copy()
-            wide = wide.loc[wide['Normalization'] == 'Signal']
-            wide['Sample'] = wide['Sample'].astype(str) + ' ' + wide['Channel']
-            wide.drop(['Channel', 'Normalization'], axis = 1)
+            wide = self.wide_hplc[['Time', 'Sample', 'Channel', 'Signal']].copy()
+            wide['Sample'] = wide['Sample'].astype(str) + ' ' + wide['Channel'].astype(str)
             wide = wide.pivot_table(
                 index = 'Time',
                 columns = 'Sample',
-                values = 'Value'
+                values = 'Signal'
             )
 
             wide.to_csv(outfile + '-wide.csv', index = True)
@@ -161,7 +231,7 @@ class Experiment:
         if outfile[-4:] != '.csv':
             outfile = outfile + '.csv'
         
-        if self.fplc is not None:
+        if self.wide_fplc is not None:
             self.fplc.to_csv(outfile, index = False)
             return outfile
 
@@ -172,29 +242,51 @@ class Experiment:
         return hplc_csv, fplc_csv
 
 
-def concat_experiments(exp_list):
-        hplcs = []
-        fplcs = []
+def stack(tables):
+    # Stack tables given as {column: Series}. Label columns are joined on
+    # their codes over the union of every table's categories, so they stay
+    # categorical without a label being written out for each row.
+    columns = list(tables[0])
+    if any(list(x) != columns for x in tables):
+        return pd.concat([pd.DataFrame(x) for x in tables], ignore_index = True)
 
-        for exp in [x for x in exp_list if x.hplc is not None]:
-            hplc = exp.hplc
-            hplc['Sample'] = f'{exp.id}: ' + hplc['Sample'].astype(str)
-            hplcs.append(hplc)
+    stacked = {}
+    for column in columns:
+        parts = [x[column] for x in tables]
+        if all(isinstance(x.dtype, pd.CategoricalDtype) for x in parts):
+            stacked[column] = union_categoricals(parts)
+        else:
+            stacked[column] = pd.concat(parts, ignore_index = True)
 
-        for exp in [x for x in exp_list if x.fplc is not None]:
-            fplc = exp.fplc
-            fplc['Sample'] = exp.id
-            fplcs.append(fplc)
+    return pd.DataFrame(stacked)
 
-        concat_exp = Experiment('concat')
-        try:
-            concat_exp.hplc = pd.concat(hplcs)
-        except ValueError:
-            pass
+def concat_experiments(exp_list):
+    # Samples are relabelled "{experiment}: {sample}", except that an
+    # experiment with a single FPLC run names it after the experiment. Only
+    # categories are renamed, and the experiments passed in are left alone.
+    hplcs = []
+    fplcs = []
+
+    for exp in [x for x in exp_list if x.wide_hplc is not None]:
+        samples = exp.wide_hplc['Sample']
+        hplcs.append(dict(
+            exp.wide_hplc.items(),
+            Sample = rename_labels(samples, {x: f'{exp.id}: {x}' for x in samples.cat.categories})
+        ))
+
+    for exp in [x for x in exp_list if x.wide_fplc is not None]:
+        samples = exp.wide_fplc['Sample']
+        if len(samples.cat.categories) == 1:
+            names = {x: exp.id for x in samples.cat.categories}
+        else:
+            names = {x: f'{exp.id}: {x}' for x in samples.cat.categories}
+        fplcs.append(dict(exp.wide_fplc.items(), Sample = rename_labels(samples, names)))
 
-        try:
-            concat_exp.fplc = pd.concat(fplcs)
-        except ValueError:
-            pass
-        
-        return concat_exp
\ No newline at end of file
+    concat_exp = Experiment('concat')
+    if hplcs:
+        concat_exp.hplc = stack(hplcs)
+
+    if fplcs:
+        concat_exp.fplc = stack(fplcs)
+
+    return concat_exp
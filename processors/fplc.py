@@ -1,73 +1,87 @@
 import pandas as pd
+import numpy as np
 import os
-from .core import normalizer, loading_bar
+from .core import normalize, read_files, concat_chroms, decode_utf16, register_format
 
-def append_fplc(file_list, cv = 24):
+def sniff_akta(first_line):
+    # AKTA files all have headers that say 'Chrom.1'
+    return first_line.split()[:1] == ['Chrom.1']
+
+register_format('akta', ['.csv'], sniff_akta)
+
+def read_fplc(file):
+    text = decode_utf16(file)
+
+    # The first two lines are the run and curve names, the third has the units
+    text.readline()
+    text.readline()
+    header = text.readline().rstrip('\r\n').split('\t')
+
+    # The AKTA exports data with several different ml columns, all with the
+    # same name. These are mL axes for each channel, and always come right
+    # before the channel they belong to. Unfortunately, they are different for
+    # each channel! So we need to keep each and know which channel it goes
+    # with. Additionally, since users don't have to export every channel every
+    # time, we can't hard code positions. Only these columns are parsed; the
+    # rest of the export is skipped.
+    names = {}
+    for col_name in ['mAU', 'mS/cm', '%', 'Fraction']:
+        if col_name in header:
+            column = header.index(col_name)
+            names[column - 1] = f'mL_{col_name}'
+            names[column] = col_name
+
+    fplc_trace = pd.read_csv(
+        text,
+        sep = '\t',
+        header = None,
+        usecols = list(names.keys()),
+        dtype = {i: str if names[i] == 'Fraction' else np.float64 for i in names}
+    )
+
+    return fplc_trace.rename(columns = names)
+
+def append_fplc(file_list, cv = 24, jobs = 1):
     if isinstance(file_list, str):
         file_list = [file_list]
 
-    chroms = pd.DataFrame(columns = ['mL', 'CV', 'Channel', 'Signal', 'Fraction', 'Sample'])
-    for i in range(len(file_list)):
-
-        loading_bar(i+1, (len(file_list)), extension = ' AKTA files')
-        file = file_list[i]
-
-        fplc_trace = pd.read_csv(
-            file, skiprows = 1,
-            header = [1],
-            encoding = 'utf-16-le',
-            delimiter = '\t',
-            engine = 'python'
-        )
-
-        # The AKTA exports data with several different ml columns, each with their
-        # own name (like ml.2, ml.3, etc.). These are mL axes for each channel.
-        # Unfortunately, they are different for each channel! So we need to keep
-        # each and know which channel it goes with. Additionally, since users
-        # don't have to export every channel every time, we can't hard code positions
-        
-        fplc_trace = fplc_trace.filter(regex = '(ml|mAU$|mS/cm$|\%$|Fraction)')
-        columns = fplc_trace.columns
-        renaming = {}
-        for col_name in ['mAU', 'mS/cm', '%', 'Fraction']:
-            if col_name in columns:
-                column = columns.get_loc(col_name)
-                renaming[columns[column-1]] = f'mL_{col_name}'
-
-        fplc_trace = fplc_trace.rename(columns = renaming)
-
-        long_trace = pd.DataFrame(columns = ['mL', 'Channel', 'Signal'])
+    traces = read_files(read_fplc, file_list, jobs, extension = ' AKTA files')
+
+    chroms = []
+    for file, fplc_trace in zip(file_list, traces):
+        long_trace = []
         for column in ['mAU', 'mS/cm', '%']:
-            channel = pd.melt(
-                fplc_trace,
-                id_vars = [f'mL_{column}'],
-                value_vars = [column],
-                var_name = 'Channel',
-                value_name = 'Signal')
-            channel = channel.rename(columns = {f'mL_{column}':'mL'}).dropna()
-            long_trace = long_trace.append(channel)
-
-        long_trace['Fraction'] = 1
-        frac_mL = fplc_trace['mL_Fraction'].dropna()
-        for i in range(len(frac_mL)):
-            # The +2 here is a magic number. For whatever reason, the fractions
-            # generated by this method were off by two from those displayed in
-            # the AKTA software. And since those are where your protein actually
-            # ends up, it's pretty important that everything matches.
-            long_trace.loc[long_trace['mL'] > frac_mL[i], 'Fraction'] = i + 2
+            if column not in fplc_trace:
+                continue
+
+            channel = pd.DataFrame({
+                'mL': fplc_trace[f'mL_{column}'],
+                'Channel': column,
+                'Signal': fplc_trace[column]
+            }).dropna()
+            long_trace.append(channel)
+
+        long_trace = pd.concat(long_trace, ignore_index = True)
+
+        # Points past fraction mark i belong to fraction i + 2, so each point
+        # gets one more than the number of marks below it. The +2 here is a
+        # magic number. For whatever reason, the fractions generated by this
+        # method were off by two from those displayed in the AKTA software. And
+        # since those are where your protein actually ends up, it's pretty
+        # important that everything matches.
+        if 'mL_Fraction' in fplc_trace:
+            frac_mL = fplc_trace['mL_Fraction'].dropna().to_numpy()
+            long_trace['Fraction'] = np.searchsorted(frac_mL, long_trace['mL'].to_numpy(), side = 'left') + 1
+        else:
+            long_trace['Fraction'] = 1
 
         long_trace['CV'] = long_trace['mL']/cv
+        long_trace['Sample'] = os.path.split(file)[1][:-4]
+        long_trace = long_trace.loc[(long_trace.CV >= 0) & (long_trace.CV <=1)]
 
-        chroms = chroms.append(long_trace, ignore_index = True)
-        chroms.Sample = os.path.split(file)[1][:-4]
-        chroms = chroms.loc[(chroms.CV >= 0) & (chroms.CV <=1)]
+        chroms.append(long_trace)
 
-        chroms = chroms.groupby(['Channel']).apply(normalizer)
-        chroms = chroms.melt(
-            id_vars = ['mL', 'CV', 'Channel', 'Fraction', 'Sample'],
-            value_vars = ['Signal', 'Normalized'],
-            var_name = 'Normalization',
-            value_name = 'Value'
-        )
+    chroms = concat_chroms(chroms, ['mL', 'CV', 'Channel', 'Signal', 'Fraction', 'Sample'])
+    chroms = normalize(chroms, ['Sample', 'Channel'])
 
-        return chroms
\ No newline at end of file
+    return chroms
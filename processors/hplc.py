@@ -1,162 +1,249 @@
 import pandas as pd
 import numpy as np
 import sys
+import csv
 import json
 import os
 import logging
 import re
-from .core import loading_bar, normalizer
-
-def get_flow_rate(flow_rate, method):
-    # If user provides in argument we don't need to do this
-    if flow_rate:
-        return flow_rate
-    
-    # Open flow-rates JSON
-    if method:
-        # Open flow-rates JSON
-        script_location = os.path.dirname(os.path.realpath(__file__))
+from collections import namedtuple
+from .core import read_files, normalize, concat_chroms, decode_utf16, register_format
+
+def sniff_agilent(first_line):
+    # Agilent files have no header, so if we can make a float from the first
+    # cell, it's an Agilent file
+    try:
+        float(first_line.split()[0])
+        return True
+    except (ValueError, IndexError):
+        return False
+
+register_format('waters', ['.arw'])
+register_format('shimadzu', ['.asc'])
+register_format('agilent', ['.csv'], sniff_agilent)
+
+class FlowRates:
+    # Flow rates by instrument method name, from flow_rates.json. Keys match
+    # a method exactly, as a substring, or as a regular expression if they
+    # start with 're:'. The JSON is read once and each method is only
+    # resolved once per process.
+    def __init__(self, path) -> None:
+        self.path = path
+        self.exact = None
+        self.patterns = None
+        self.resolved = {}
+
+    def load(self):
         try:
-            with open(os.path.join(script_location, 'flow_rates.json')) as fr:
+            with open(self.path) as fr:
                 flow_rates = json.load(fr)
-
-            match = False
-            for key in flow_rates:
-                if key in method:
-                    if match:
-                        logging.error('Multiple matches in flow_rates JSON!')
-                        match = False
-                        break
-                    else:
-                        match = True
-                        flow_rate = flow_rates[key]
-
-            if match:
-                return flow_rate
         except FileNotFoundError:
             logging.warning('No flow_rates JSON found.')
-    
-    flow_rate = float(input(f'Flow rate (mL/min):'))
-    return flow_rate
-
-
-def append_waters(file_list, flow_rate = None):
-
-    chroms = pd.DataFrame(columns = ['Time', 'Signal', 'Channel', 'Sample'])
-
-    for i in range(len(file_list)):
-        loading_bar(i+1, (len(file_list)), extension = ' Waters files')
-        file = file_list[i]
-        to_append = pd.read_csv(
-				file,
-				delim_whitespace = True,
-				skiprows = 2,
-				names = ["Time", "Signal"],
-				header = None,
-				dtype = {'Time': np.float32, 'Signal': np.float32}
-			)
-        if to_append.shape[0] == 0:
-            logging.warning(f'File {file} is empty. Ignoring that file.')
-            continue
-        sample_info = pd.read_csv(
-            file,
-            delim_whitespace = True,
-            nrows = 2,
-            dtype = str
-        )
-
-        # pull sample info from the headers (in a separate df since the shape
-        # is inconsistent). Then add the data
-
-        sample_name = str(sample_info.loc[0]['SampleName'])
-        channel_ID = str(sample_info.loc[0]['Channel'])
-        try:
-            set_name = str(sample_info.loc[0]['Sample Set Name'])
-        except KeyError:
-            logging.error('\nNo Sample Set Name found in arw file')
-            set_name = None
-        to_append['Channel'] = channel_ID
-        to_append['Sample'] = sample_name
+            flow_rates = {}
+
+        self.exact = {}
+        self.patterns = []
+        for key, rate in flow_rates.items():
+            if key.startswith('re:'):
+                self.patterns.append((re.compile(key[3:]), rate))
+            else:
+                self.exact[key] = rate
+                self.patterns.append((re.compile(re.escape(key)), rate))
+
+    def lookup(self, method):
+        if self.exact is None:
+            self.load()
+
+        if method in self.exact:
+            return self.exact[method]
+
+        matches = [rate for pattern, rate in self.patterns if pattern.search(method)]
+        if len(matches) > 1:
+            logging.error('Multiple matches in flow_rates JSON!')
+        elif matches:
+            return matches[0]
+
+    def resolve(self, method, default = None, prompt = True):
+        if method in self.resolved:
+            return self.resolved[method]
+
+        flow_rate = self.lookup(method) if method else None
+
+        if flow_rate is None:
+            if default is not None:
+                flow_rate = default
+            elif prompt:
+                flow_rate = float(input(f'Flow rate (mL/min):'))
+            else:
+                raise ValueError(f'No flow rate found for instrument method "{method}"')
+
+        self.resolved[method] = flow_rate
+        return flow_rate
 
+flow_rates = FlowRates(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'flow_rates.json'))
 
-        if 'Instrument Method Name' in sample_info:
-            method = str(sample_info.loc[0]['Instrument Method Name'])
-        else:
-            method = False
-        flow_rate = get_flow_rate(flow_rate, method)
+def get_flow_rate(flow_rate, method, default = None, prompt = True):
+    # If user provides in argument we don't need to do this
+    if flow_rate:
+        return flow_rate
 
-        to_append['mL'] = to_append['Time']*flow_rate
+    return flow_rates.resolve(method, default, prompt)
 
-        chroms = chroms.append(to_append, ignore_index = False)
 
-    chroms = chroms.groupby(['Sample', 'Channel']).apply(normalizer)
-    chroms = chroms.melt(
-        id_vars = ['mL', 'Sample', 'Channel', 'Time'],
-        value_vars = ['Signal', 'Normalized'],
-        var_name = 'Normalization',
-        value_name = 'Value'
+# Everything append_waters needs from one .arw file
+WatersFile = namedtuple('WatersFile', ['sample', 'channel', 'set_name', 'method', 'time', 'signal'])
+
+def read_waters(file):
+    # Read the two header rows and the trace from a single open of the file.
+    # Text mode takes care of the bare carriage returns Empower exports use.
+    with open(file, 'r') as f:
+        header = list(csv.reader([f.readline(), f.readline()], delimiter = '\t'))
+
+        try:
+            trace = pd.read_csv(
+                f,
+                sep = r'\s+',
+                names = ['Time', 'Signal'],
+                header = None,
+                dtype = np.float32
+            )
+        except pd.errors.EmptyDataError:
+            trace = pd.DataFrame(columns = ['Time', 'Signal'], dtype = np.float32)
+
+    # pull sample info from the headers. Missing keys are handled by the caller
+    sample_info = dict(zip(header[0], header[1])) if len(header) == 2 else {}
+
+    return WatersFile(
+        sample = sample_info.get('SampleName'),
+        channel = sample_info.get('Channel'),
+        set_name = sample_info.get('Sample Set Name'),
+        method = sample_info.get('Instrument Method Name', False),
+        time = trace['Time'].to_numpy(),
+        signal = trace['Signal'].to_numpy()
     )
 
-    return chroms, set_name
+def run_info(sample, set_name = None, method = None, flow_rate = None):
+    # What an experiment records about each HPLC sample, for searching
+    return {
+        'sample': str(sample),
+        'set_name': set_name,
+        'method': method or None,
+        'flow_rate': float(flow_rate) if flow_rate else None
+    }
+
+def append_waters(file_list, flow_rate = None, jobs = 1, default_flow_rate = None, prompt = True):
 
-def append_shim(file_list, channel_mapping, flow_rate = None):
-    chroms = pd.DataFrame(columns = ['Time', 'Signal', 'Channel', 'Sample'])
+    chroms = []
+    runs = []
+    set_name = None
 
-    channel_names = list(channel_mapping.keys())
+    records = read_files(read_waters, file_list, jobs, extension = ' Waters files')
 
-    for i in range(len(file_list)):
+    for file, record in zip(file_list, records):
+        if record.time.shape[0] == 0:
+            logging.warning(f'File {file} is empty. Ignoring that file.')
+            continue
 
-        loading_bar(i+1, (len(file_list)), extension = ' Shimadzu files')
-        file = file_list[i]
+        set_name = record.set_name
+        if set_name is None:
+            logging.error('\nNo Sample Set Name found in arw file')
 
-        to_append = pd.read_csv(
-            file,
-            sep = '\t',
-            skiprows = 16,
+        file_flow_rate = get_flow_rate(flow_rate, record.method, default_flow_rate, prompt)
+        # one file per channel, but one run per sample
+        if not any(x['sample'] == str(record.sample) for x in runs):
+            runs.append(run_info(record.sample, set_name, record.method, file_flow_rate))
+
+        chroms.append(pd.DataFrame({
+            'Time': record.time,
+            'Signal': record.signal,
+            'Channel': str(record.channel),
+            'Sample': str(record.sample),
+            'mL': record.time * file_flow_rate
+        }))
+
+    chroms = concat_chroms(chroms, ['Time', 'Signal', 'Channel', 'Sample', 'mL'])
+    chroms = normalize(chroms, ['Sample', 'Channel'])
+
+    return chroms, set_name, runs
+
+# Everything append_shim needs from one .asc file
+ShimadzuFile = namedtuple('ShimadzuFile', ['sample', 'set_name', 'trace'])
+
+def read_shim(file, channel_names):
+    # The first 16 lines are a tab-separated header of 'Stat:' followed by one
+    # value per channel. Everything after that is one signal column with each
+    # channel's points in turn.
+    with open(file, 'r') as f:
+        sample_info = {}
+        for _ in range(16):
+            stat, *values = f.readline().rstrip('\n').split('\t')
+            sample_info[stat] = values
+
+        signal = pd.read_csv(
+            f,
             names = ['Signal'],
             header = None,
             dtype = np.float32
-        )
+        )['Signal'].to_numpy()
+
+    number_samples = int(sample_info['Total Data Points:'][0])
+    sampling_interval = float(sample_info['Sampling Rate:'][0])
+    set_name = sample_info['Acquisition Date and Time:'][0].replace('/', '-').replace(' ', '_').replace(':', '-')
+    sample_name = sample_info['Sample ID:'][0]
+
+    minutes = np.arange(number_samples) * sampling_interval / 60
+
+    trace = pd.DataFrame({
+        'Signal': signal,
+        'Sample': sample_name,
+        'Channel': np.repeat(np.array(channel_names, dtype = object), number_samples),
+        'Time': np.tile(minutes, len(channel_names))
+    })
+
+    return ShimadzuFile(
+        sample = sample_name,
+        set_name = set_name,
+        trace = trace
+    )
 
-        sample_info = pd.read_csv(
-            file,
-            sep = '\t',
-            nrows = 16,
-            names = ['Stat'] + channel_names + ['Units'],
-            engine = 'python'
-        )
+def append_shim(file_list, channel_mapping, flow_rate = None, jobs = 1, default_flow_rate = None, prompt = True):
+    chroms = []
+    runs = []
+    set_name = None
 
-        sample_info.set_index('Stat', inplace = True)
+    # Shimadzu channels are just letters, so label them with the mapped names
+    # straight away
+    channel_names = list(channel_mapping.values())
 
-        number_samples = int(sample_info.loc['Total Data Points:'][0])
-        sampling_interval = float(sample_info.loc['Sampling Rate:'][0])
-        seconds_list = [x * sampling_interval for x in range(number_samples)] * len(channel_names)
-        set_name = str(sample_info.loc['Acquisition Date and Time:'][0]).replace('/', '-').replace(' ', '_').replace(':', '-')
+    records = read_files(read_shim, file_list, jobs, extension = ' Shimadzu files', args = (channel_names,))
 
-        to_append['Sample'] = str(sample_info.loc['Sample ID:'][0])
-        to_append['Channel'] = [x for x in channel_names for i in range(number_samples)]
-        to_append['Time'] = [x/60 for x in seconds_list]
+    for record in records:
+        to_append = record.trace
+        set_name = record.set_name
 
-        flow_rate = get_flow_rate(flow_rate, None)
+        flow_rate = get_flow_rate(flow_rate, None, default_flow_rate, prompt)
         to_append['mL'] = to_append['Time'] * flow_rate
+        runs.append(run_info(record.sample, set_name, flow_rate = flow_rate))
 
-        chroms = chroms.append(to_append, ignore_index = True, sort = True)
+        chroms.append(to_append)
 
-    chroms = chroms[['Time', 'Signal', 'Channel', 'Sample', 'mL']]
-    chroms = chroms.replace(channel_mapping)
+    chroms = concat_chroms(chroms, ['Time', 'Signal', 'Channel', 'Sample', 'mL'])
 
-    chroms = chroms.groupby(['Sample', 'Channel']).apply(normalizer)
-    chroms = chroms.melt(
-        id_vars = ['mL', 'Sample', 'Channel', 'Time'],
-        value_vars = 'Signal',
-        var_name = 'Normalization',
-        value_name = 'Value'
-    )
+    chroms = normalize(chroms, ['Sample', 'Channel'])
+
+    return chroms, set_name, runs
 
-    return chroms, set_name
+def read_agilent(file):
+    return pd.read_csv(
+        decode_utf16(file),
+        sep = '\t',
+        names = ['Time', 'Signal'],
+        header = None
+    )
 
-def append_agilent(file_list, flow_override = None, channel_override = None):
-    chroms = pd.DataFrame(columns = ['Time', 'Signal', 'Channel', 'Sample', 'mL'])
+def append_agilent(file_list, flow_override = None, channel_override = None, jobs = 1):
+    chroms = []
+    runs = []
 
     if channel_override:
         channel = channel_override
@@ -168,18 +255,9 @@ def append_agilent(file_list, flow_override = None, channel_override = None):
     else:
         flow_rate = False
 
-    for i in range(len(file_list)):
-
-        loading_bar(i+1, (len(file_list)), extension = ' Agilent files')
-        file = file_list[i]
+    traces = read_files(read_agilent, file_list, jobs, extension = ' Agilent files')
 
-        to_append = pd.read_csv(
-            file,
-            sep = '\t',
-            names = ['Time', 'Signal'],
-            engine = 'python',
-            encoding = 'utf_16'
-        )
+    for file, to_append in zip(file_list, traces):
 
         filename = os.path.split(file)[1]
         sample_name = filename.replace('.CSV', '').replace('_RT', '')
@@ -249,15 +327,11 @@ def append_agilent(file_list, flow_override = None, channel_override = None):
 
         # Set sample name down here so that flow and channel information have been removed
         to_append['Sample'] = sample_name
+        runs.append(run_info(sample_name, flow_rate = flow_rate))
 
-        chroms = chroms.append(to_append, ignore_index = True, sort = True)
-        
-    chroms = chroms.groupby(['Sample', 'Channel']).apply(normalizer)
-    chroms = chroms.melt(
-        id_vars = ['mL', 'Sample', 'Channel', 'Time'],
-        value_vars = 'Signal',
-        var_name = 'Normalization',
-        value_name = 'Value'
-    )
+        chroms.append(to_append)
+
+    chroms = concat_chroms(chroms, ['Time', 'Signal', 'Channel', 'Sample', 'mL'])
+    chroms = normalize(chroms, ['Sample', 'Channel'])
 
-    return chroms
+    return chroms, runs
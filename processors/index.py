@@ -0,0 +1,94 @@
+import logging
+import threading
+from .storage import Conflict
+
+def summarize(doc):
+    # Index entry for an experiment document. Documents from before version
+    # 4 don't have this metadata until they are migrated.
+    return {
+        'version': doc.get('version'),
+        'instruments': doc.get('instruments', []),
+        'sample_count': len(doc['samples']) if 'samples' in doc else None,
+        'channels': doc.get('channels', []),
+        'uploaded': doc.get('uploaded')
+    }
+
+class ExperimentIndex:
+    # Ids and metadata of every experiment in the database. The index is
+    # kept in a local (never replicated) document along with the last
+    # sequence number read from the _changes feed, so it is only built from
+    # scratch once. After that each refresh reads just the changes since the
+    # stored sequence.
+    doc_id = '_local/experiment-index'
+    fields = ['_id', 'version', 'instruments', 'samples', 'channels', 'uploaded']
+    batch_size = 500
+
+    def __init__(self, store) -> None:
+        self.store = store
+        self.entries = None
+        self.seq = 0
+        self.rev = None
+        self.lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        return f'ExperimentIndex of {len(self.entries or {})} experiments at sequence {self.seq}'
+
+    def load(self):
+        stored = self.store.get(self.doc_id)
+
+        if stored is None:
+            logging.info('Building experiment index')
+            self.entries = {}
+            self.seq = 0
+        else:
+            self.entries = stored['entries']
+            self.seq = stored['seq']
+            self.rev = stored['_rev']
+
+    def refresh(self):
+        with self.lock:
+            if self.entries is None:
+                self.load()
+
+            changes = self.store.changes(since = self.seq)
+
+            changed = []
+            for change in changes['results']:
+                # design documents are not experiments
+                if change['id'].startswith('_'):
+                    continue
+
+                if change.get('deleted'):
+                    self.entries.pop(change['id'], None)
+                else:
+                    changed.append(change['id'])
+
+            # only the metadata fields are fetched, so old documents with
+            # their data inline don't have to be downloaded
+            for i in range(0, len(changed), self.batch_size):
+                batch = changed[i:i + self.batch_size]
+                for doc in self.store.project(batch, self.fields):
+                    self.entries[doc['_id']] = summarize(doc)
+
+            if changes['last_seq'] != self.seq:
+                self.seq = changes['last_seq']
+                self.save()
+
+        return self.entries
+
+    def save(self):
+        doc = {'_id': self.doc_id, 'entries': self.entries, 'seq': self.seq}
+
+        for _ in range(2):
+            if self.rev is not None:
+                doc['_rev'] = self.rev
+
+            try:
+                self.rev = self.store.put(doc)
+                return
+            except Conflict:
+                # another server saved the index first. Ours is just as
+                # current, so save over it.
+                self.rev = (self.store.get(self.doc_id) or {}).get('_rev')
+
+        logging.warning('Could not save experiment index')
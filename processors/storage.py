@@ -0,0 +1,606 @@
+import couchdb
+import sqlite3
+import threading
+import weakref
+import logging
+import json
+import time
+import random
+import functools
+import http.client
+from collections import deque
+from base64 import b64decode
+from uuid import uuid4
+
+# Where Database keeps documents and their attachments. A store has:
+#   list()                                  ids of all experiment documents
+#   get(id), get_many(ids)                  documents, None if missing
+#   revs(ids)                               {id: current revision}
+#   put(doc)                                save doc and set its _rev
+#   delete(id, rev)
+#   bulk(docs)                              save or delete (_deleted) many
+#                                           docs, [(success, id, rev or error)]
+#   changes(since)                          {'results': [...], 'last_seq': seq}
+#   project(ids, fields)                    documents with only these fields
+#   put_attachment(doc, data, name, content_type), get_attachment(id, name)
+#   search(term, limit)                     [(id, field, value)] with a value
+#                                           starting with term
+# Documents behave as in CouchDB: saving needs the current _rev, saving
+# drops attachments not listed (as stubs or inline data) in _attachments,
+# and _local/ documents are left out of list() and changes().
+
+class Conflict(Exception):
+    pass
+
+class NotFound(Exception):
+    pass
+
+def search_terms(doc):
+    # (field, value) pairs an experiment can be found by. Keep this in step
+    # with the map function of the CouchDB search view.
+    if (doc.get('version') or 0) < 4:
+        return []
+
+    fields = {
+        'sample': doc.get('samples'),
+        'channel': doc.get('channels'),
+        'set_name': doc.get('set_names'),
+        'method': doc.get('methods')
+    }
+
+    return [(field, str(value)) for field, values in fields.items() for value in values or []]
+
+# A view with every searchable value of each experiment, keyed by the
+# lowercase value and the field it came from, so any prefix is one range
+# query
+search_design = {
+    '_id': '_design/appia',
+    'language': 'javascript',
+    'views': {
+        'search': {
+            'map': '''function (doc) {
+    if (doc.version >= 4) {
+        var fields = {
+            sample: doc.samples,
+            channel: doc.channels,
+            set_name: doc.set_names,
+            method: doc.methods
+        };
+        for (var field in fields) {
+            (fields[field] || []).forEach(function (value) {
+                emit([String(value).toLowerCase(), field], String(value));
+            });
+        }
+    }
+}'''
+        }
+    }
+}
+
+class RequestStats:
+    # Latency of the requests a store makes, by operation: totals since the
+    # store was opened, and percentiles of the last `window` requests
+    def __init__(self, window = 1000) -> None:
+        self.window = window
+        self.ops = {}
+        self.lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        return f'RequestStats for {sum(x["count"] for x in self.ops.values())} requests'
+
+    def op(self, name):
+        # call with the lock held
+        if name not in self.ops:
+            self.ops[name] = {
+                'count': 0,
+                'errors': 0,
+                'retries': 0,
+                'total': 0.0,
+                'max': 0.0,
+                'recent': deque(maxlen = self.window)
+            }
+
+        return self.ops[name]
+
+    def record(self, name, seconds, ok = True):
+        with self.lock:
+            op = self.op(name)
+            op['count'] += 1
+            op['errors'] += not ok
+            op['total'] += seconds
+            op['max'] = max(op['max'], seconds)
+            op['recent'].append(seconds)
+
+    def retried(self, name):
+        with self.lock:
+            self.op(name)['retries'] += 1
+
+    def summary(self):
+        # {operation: counts and latencies in ms}
+        with self.lock:
+            ops = {name: dict(op, recent = sorted(op['recent'])) for name, op in self.ops.items()}
+
+        return {
+            name: {
+                'count': op['count'],
+                'errors': op['errors'],
+                'retries': op['retries'],
+                'mean_ms': round(1000 * op['total'] / op['count'], 1),
+                'p50_ms': round(1000 * op['recent'][len(op['recent']) // 2], 1),
+                'p95_ms': round(1000 * op['recent'][int(0.95 * (len(op['recent']) - 1))], 1),
+                'max_ms': round(1000 * op['max'], 1)
+            } for name, op in ops.items()
+        }
+
+class ReadTimeout:
+    # Connections open with the connect timeout, then wait up to read_timeout
+    # for each response. This also covers reconnecting a closed connection.
+    read_timeout = None
+
+    def connect(self):
+        super().connect()
+        self.sock.settimeout(self.read_timeout)
+
+class TimeoutHTTPConnection(ReadTimeout, http.client.HTTPConnection):
+    pass
+
+class TimeoutHTTPSConnection(ReadTimeout, http.client.HTTPSConnection):
+    pass
+
+class BoundedConnectionPool(couchdb.http.ConnectionPool):
+    # Keep-alive connections shared by every thread, at most `size` open at
+    # once. A thread that finds none idle and none left to open waits up to
+    # the connect timeout for one to be released or closed, then fails with
+    # a TimeoutError (which reads retry). couchdb drops connections that
+    # failed without releasing them, so a connection counts as open until
+    # it is garbage collected.
+    def __init__(self, size, connect_timeout, read_timeout) -> None:
+        super().__init__(connect_timeout)
+        self.size = size
+        self.read_timeout = read_timeout
+        # reentrant, as a connection can be collected while the lock is held
+        self.lock = threading.RLock()
+        self.changed = threading.Condition(self.lock)
+        self.waiting = deque()
+        self.open = 0
+        self.opened = 0
+
+    def get(self, url):
+        scheme, host = couchdb.util.urlsplit(url, 'http', False)[:2]
+        if scheme == 'http':
+            connection = TimeoutHTTPConnection
+        elif scheme == 'https':
+            connection = TimeoutHTTPSConnection
+        else:
+            raise ValueError(f'{scheme} is not a supported scheme')
+
+        # waiting threads are served in turn, so a thread that releases a
+        # connection and asks again cannot take it back from one that waited
+        deadline = time.monotonic() + self.timeout
+        turn = object()
+        with self.changed:
+            conns = self.conns.setdefault((scheme, host), [])
+            self.waiting.append(turn)
+            try:
+                while self.waiting[0] is not turn or not conns and self.open >= self.size:
+                    left = deadline - time.monotonic()
+                    if left <= 0 or not self.changed.wait(left):
+                        raise TimeoutError(f'All {self.size} connections to {host} are busy')
+            finally:
+                self.waiting.remove(turn)
+                self.changed.notify_all()
+            if conns:
+                return conns.pop()
+            self.open += 1
+            self.opened += 1
+
+        conn = connection(host, timeout = self.timeout)
+        weakref.finalize(conn, self.closed)
+        conn.read_timeout = self.read_timeout
+        conn.connect()
+
+        return conn
+
+    def release(self, url, conn):
+        scheme, host = couchdb.util.urlsplit(url, 'http', False)[:2]
+
+        with self.changed:
+            self.conns.setdefault((scheme, host), []).append(conn)
+            self.changed.notify_all()
+
+    def closed(self):
+        with self.changed:
+            self.open -= 1
+            self.changed.notify_all()
+
+class LockedCache(couchdb.http.Cache):
+    # the ETag cache of a session, safe to share between threads
+    def __init__(self) -> None:
+        super().__init__()
+        self.lock = threading.Lock()
+
+    def get(self, url):
+        with self.lock:
+            return super().get(url)
+
+    def put(self, url, response):
+        with self.lock:
+            super().put(url, response)
+
+    def remove(self, url):
+        with self.lock:
+            super().remove(url)
+
+class PooledSession(couchdb.http.Session):
+    # One session for every thread using a CouchStore. couchdb's own retry
+    # (once, straight away) is left on: it reopens kept-alive connections the
+    # server has closed.
+    def __init__(self, pool_size, connect_timeout, read_timeout) -> None:
+        super().__init__(retry_delays = [0])
+        self.cache = LockedCache()
+        self.connection_pool = BoundedConnectionPool(pool_size, connect_timeout, read_timeout)
+
+def transient(error):
+    # errors worth retrying: network trouble, timeouts and server errors
+    if isinstance(error, couchdb.http.ServerError):
+        return error.args[0][0] >= 500
+
+    return isinstance(error, (OSError, http.client.HTTPException))
+
+def request(read = False):
+    # Record how long each call of a CouchStore method takes. Reads that fail
+    # with a transient error are retried after 0.5, 1, 2... seconds (up to
+    # max_delay, with some jitter), at most `retries` times. Writes are never
+    # retried, as they may have gone through.
+    def decorate(method):
+        name = method.__name__
+
+        @functools.wraps(method)
+        def timed(self, *args, **kwargs):
+            attempt = 0
+            while True:
+                start = time.perf_counter()
+                try:
+                    result = method(self, *args, **kwargs)
+                except Exception as e:
+                    self.stats.record(name, time.perf_counter() - start, ok = False)
+                    if not read or attempt >= self.retries or not transient(e):
+                        raise
+
+                    delay = min(self.max_delay, self.retry_delay * 2**attempt) * random.uniform(0.5, 1)
+                    attempt += 1
+                    self.stats.retried(name)
+                    logging.warning(f'CouchDB {name} failed ({e!r}), retry {attempt} of {self.retries} in {delay:.1f} s')
+                    time.sleep(delay)
+                else:
+                    elapsed = time.perf_counter() - start
+                    self.stats.record(name, elapsed)
+                    logging.debug(f'CouchDB {name} took {1000 * elapsed:.1f} ms')
+                    return result
+
+        return timed
+
+    return decorate
+
+class CouchStore:
+    # Every thread shares one pooled session. Settings:
+    #   pool_size          most connections open at once
+    #   connect_timeout    seconds to wait for a connection
+    #   read_timeout       seconds to wait for each response
+    #   retries            times to retry a failed read
+    retry_delay = 0.5
+    max_delay = 8
+
+    def __init__(
+        self, user, password, host, dbname = 'traces',
+        pool_size = 10, connect_timeout = 5, read_timeout = 30, retries = 3
+    ) -> None:
+        self.host = host
+        self.retries = retries
+        self.stats = RequestStats()
+        self.session = PooledSession(pool_size, connect_timeout, read_timeout)
+        couchserver = couchdb.Server(f'http://{user}:{password}@{host}:5984', session = self.session)
+
+        if dbname in couchserver:
+            self.db = couchserver[dbname]
+        else:
+            self.db = couchserver.create(dbname)
+
+        self.update_design()
+
+    def __repr__(self) -> str:
+        return f'CouchDB at {self.host}'
+
+    def update_design(self):
+        design = self.db.get(search_design['_id'])
+        if design is not None and design.get('views') == search_design['views']:
+            return
+
+        new_design = dict(search_design)
+        if design is not None:
+            new_design['_rev'] = design['_rev']
+
+        try:
+            self.db.save(new_design)
+        except (couchdb.http.Unauthorized, couchdb.http.Forbidden):
+            logging.warning('Not allowed to update the search view. Searches may be out of date.')
+        except couchdb.http.ResourceConflict:
+            # another server updated it first
+            pass
+
+    @request(read = True)
+    def list(self):
+        return [x.id for x in self.db.view('_all_docs') if not x.id.startswith('_')]
+
+    @request(read = True)
+    def get(self, id):
+        return self.db.get(id)
+
+    @request(read = True)
+    def get_many(self, ids):
+        return [row.doc for row in self.db.view('_all_docs', keys = list(ids), include_docs = True)]
+
+    @request(read = True)
+    def revs(self, ids):
+        return {
+            row.id: row.value['rev'] for row in self.db.view('_all_docs', keys = list(ids))
+            if not row.error and not row.value.get('deleted')
+        }
+
+    @request()
+    def put(self, doc):
+        try:
+            return self.db.save(doc)[1]
+        except couchdb.http.ResourceConflict:
+            raise Conflict(doc['_id'])
+
+    @request()
+    def delete(self, id, rev):
+        try:
+            self.db.delete({'_id': id, '_rev': rev})
+        except couchdb.http.ResourceNotFound:
+            raise NotFound(id)
+        except couchdb.http.ResourceConflict:
+            raise Conflict(id)
+
+    @request()
+    def bulk(self, docs):
+        return self.db.update(docs)
+
+    @request(read = True)
+    def changes(self, since = 0):
+        return self.db.changes(since = since)
+
+    @request(read = True)
+    def project(self, ids, fields):
+        return list(self.db.find({
+            'selector': {'_id': {'$in': list(ids)}},
+            'fields': fields,
+            'limit': len(ids)
+        }))
+
+    @request()
+    def put_attachment(self, doc, data, name, content_type):
+        try:
+            self.db.put_attachment(doc, data, name, content_type)
+        except couchdb.http.ResourceConflict:
+            raise Conflict(doc['_id'])
+
+    @request(read = True)
+    def get_attachment(self, id, name):
+        attachment = self.db.get_attachment(id, name)
+        if attachment is not None:
+            return attachment.read()
+
+    @request(read = True)
+    def search(self, term, limit = 1000):
+        return [
+            (row.id, row.key[1], row.value) for row in
+            self.db.view('appia/search', startkey = [term], endkey = [term + '\ufff0'], limit = limit)
+        ]
+
+class SQLiteStore:
+    # Documents and attachments in one local SQLite file, for running appia
+    # without a CouchDB server. Each write gets the next sequence number, so
+    # changes() works like the _changes feed. One connection is shared
+    # between threads and used under a lock.
+    def __init__(self, path) -> None:
+        self.path = path
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(path, check_same_thread = False)
+
+        with self.lock, self.conn:
+            self.conn.executescript('''
+                CREATE TABLE IF NOT EXISTS docs (
+                    id TEXT PRIMARY KEY,
+                    rev TEXT NOT NULL,
+                    seq INTEGER,
+                    deleted INTEGER NOT NULL DEFAULT 0,
+                    body TEXT
+                );
+                CREATE INDEX IF NOT EXISTS docs_seq ON docs (seq);
+                CREATE TABLE IF NOT EXISTS attachments (
+                    id TEXT,
+                    name TEXT,
+                    content_type TEXT,
+                    data BLOB,
+                    PRIMARY KEY (id, name)
+                );
+                CREATE TABLE IF NOT EXISTS terms (
+                    term TEXT,
+                    field TEXT,
+                    value TEXT,
+                    id TEXT
+                );
+                CREATE INDEX IF NOT EXISTS terms_term ON terms (term);
+                CREATE INDEX IF NOT EXISTS terms_id ON terms (id);
+            ''')
+
+    def __repr__(self) -> str:
+        return f'SQLite store at {self.path}'
+
+    def current_rev(self, id):
+        row = self.conn.execute('SELECT rev, deleted FROM docs WHERE id = ?', (id,)).fetchone()
+        if row is not None and not row[1]:
+            return row[0]
+
+    def next_rev(self, id):
+        row = self.conn.execute('SELECT rev FROM docs WHERE id = ?', (id,)).fetchone()
+        generation = int(row[0].split('-')[0]) if row is not None else 0
+
+        return f'{generation + 1}-{uuid4().hex}'
+
+    def next_seq(self, id):
+        if id.startswith('_local/'):
+            return None
+
+        return self.conn.execute('SELECT COALESCE(MAX(seq), 0) + 1 FROM docs').fetchone()[0]
+
+    def write(self, doc):
+        # save or delete one document. Call with the lock held, inside a
+        # transaction
+        id = doc['_id']
+        if doc.get('_rev') != self.current_rev(id):
+            raise Conflict(id)
+
+        rev = self.next_rev(id)
+        self.conn.execute('DELETE FROM terms WHERE id = ?', (id,))
+
+        if doc.get('_deleted'):
+            if doc.get('_rev') is None:
+                raise NotFound(id)
+
+            self.conn.execute('DELETE FROM attachments WHERE id = ?', (id,))
+            self.conn.execute(
+                'UPDATE docs SET rev = ?, seq = ?, deleted = 1, body = NULL WHERE id = ?',
+                (rev, self.next_seq(id), id)
+            )
+            return rev
+
+        attachments = doc.get('_attachments', {})
+        for name, attachment in attachments.items():
+            if 'data' in attachment:
+                self.conn.execute(
+                    'INSERT OR REPLACE INTO attachments VALUES (?, ?, ?, ?)',
+                    (id, name, attachment.get('content_type'), b64decode(attachment['data']))
+                )
+
+        stored = [x[0] for x in self.conn.execute('SELECT name FROM attachments WHERE id = ?', (id,))]
+        for name in stored:
+            if name not in attachments:
+                self.conn.execute('DELETE FROM attachments WHERE id = ? AND name = ?', (id, name))
+
+        body = {k: v for k, v in doc.items() if k not in ('_id', '_rev', '_attachments')}
+        self.conn.execute(
+            'INSERT OR REPLACE INTO docs VALUES (?, ?, ?, 0, ?)',
+            (id, rev, self.next_seq(id), json.dumps(body))
+        )
+        self.conn.executemany(
+            'INSERT INTO terms VALUES (?, ?, ?, ?)',
+            [(value.lower(), field, value, id) for field, value in search_terms(doc)]
+        )
+
+        doc['_rev'] = rev
+        return rev
+
+    def list(self):
+        with self.lock:
+            return [x[0] for x in self.conn.execute(
+                "SELECT id FROM docs WHERE deleted = 0 AND substr(id, 1, 1) != '_' ORDER BY id"
+            )]
+
+    def get(self, id):
+        with self.lock:
+            row = self.conn.execute('SELECT rev, body FROM docs WHERE id = ? AND deleted = 0', (id,)).fetchone()
+            if row is None:
+                return None
+
+            doc = dict(json.loads(row[1]), _id = id, _rev = row[0])
+            attachments = {
+                name: {'content_type': content_type, 'length': length, 'stub': True}
+                for name, content_type, length in self.conn.execute(
+                    'SELECT name, content_type, length(data) FROM attachments WHERE id = ?', (id,)
+                )
+            }
+
+        if attachments:
+            doc['_attachments'] = attachments
+
+        return doc
+
+    def get_many(self, ids):
+        return [self.get(x) for x in ids]
+
+    def revs(self, ids):
+        with self.lock:
+            return {x: rev for x in ids for rev in [self.current_rev(x)] if rev is not None}
+
+    def put(self, doc):
+        with self.lock, self.conn:
+            return self.write(doc)
+
+    def delete(self, id, rev):
+        with self.lock, self.conn:
+            self.write({'_id': id, '_rev': rev, '_deleted': True})
+
+    def bulk(self, docs):
+        # like _bulk_docs, each document succeeds or fails on its own
+        results = []
+        with self.lock, self.conn:
+            for doc in docs:
+                try:
+                    results.append((True, doc['_id'], self.write(doc)))
+                except (Conflict, NotFound) as e:
+                    results.append((False, doc['_id'], e))
+
+        return results
+
+    def changes(self, since = 0):
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT id, rev, seq, deleted FROM docs WHERE seq > ? ORDER BY seq', (since,)
+            ).fetchall()
+
+        results = []
+        for id, rev, seq, deleted in rows:
+            change = {'id': id, 'seq': seq, 'changes': [{'rev': rev}]}
+            if deleted:
+                change['deleted'] = True
+            results.append(change)
+
+        return {'results': results, 'last_seq': rows[-1][2] if rows else since}
+
+    def project(self, ids, fields):
+        return [{k: v for k, v in doc.items() if k in fields} for doc in self.get_many(ids) if doc is not None]
+
+    def put_attachment(self, doc, data, name, content_type):
+        with self.lock, self.conn:
+            id = doc['_id']
+            if doc.get('_rev') is None or doc['_rev'] != self.current_rev(id):
+                raise Conflict(id)
+
+            rev = self.next_rev(id)
+            self.conn.execute('INSERT OR REPLACE INTO attachments VALUES (?, ?, ?, ?)', (id, name, content_type, data))
+            self.conn.execute('UPDATE docs SET rev = ?, seq = ? WHERE id = ?', (rev, self.next_seq(id), id))
+
+        doc['_rev'] = rev
+
+    def get_attachment(self, id, name):
+        with self.lock:
+            row = self.conn.execute('SELECT data FROM attachments WHERE id = ? AND name = ?', (id, name)).fetchone()
+
+        if row is not None:
+            return bytes(row[0])
+
+    def search(self, term, limit = 1000):
+        with self.lock:
+            return self.conn.execute(
+                'SELECT id, field, value FROM terms WHERE term >= ? AND term < ? ORDER BY term, field, id LIMIT ?',
+                (term, term + '\U0010ffff', limit)
+            ).fetchall()
+
+def open_store(config):
+    if config.sqlite:
+        return SQLiteStore(config.sqlite)
+
+    return CouchStore(config.cuser, config.cpass, config.chost, **config.couch_options)
@@ -4,23 +4,25 @@ import os
 import logging
 from time import sleep
 
-sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-try:
-    result = sock.connect_ex((os.environ['COUCHDB_HOST'], 5984))
-except socket.error:
-    logging.debug('Server refused connection')
-    result = 1
-
-while result != 0:
-    logging.debug('CouchDB port not open')
-    sleep(5)
+# a local SQLite store needs no CouchDB to wait for
+if 'APPIA_SQLITE' not in os.environ:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     try:
         result = sock.connect_ex((os.environ['COUCHDB_HOST'], 5984))
     except socket.error:
         logging.debug('Server refused connection')
         result = 1
 
-logging.info('Port is open')
+    while result != 0:
+        logging.debug('CouchDB port not open')
+        sleep(5)
+        try:
+            result = sock.connect_ex((os.environ['COUCHDB_HOST'], 5984))
+        except socket.error:
+            logging.debug('Server refused connection')
+            result = 1
+
+    logging.info('Port is open')
 
 
 from waitress import serve
@@ -5,64 +5,169 @@ import dash_core_components as dcc
 import dash_html_components as html
 import plotly.express as px
 import plotly.graph_objects as go
+import plotly.io as pio
+import numpy as np
+import json
+import copy
 from urllib.parse import parse_qs
+from flask import jsonify
 from numpy import dstack
 from processors.database import Database, Config
+from processors.cache import ExperimentCache, FigureCache
 from processors.experiment import concat_experiments
+from processors.codec import grid
 
 url_basename = '/traces/'
 app = dash.Dash(__name__, url_base_pathname = url_basename)
 server = app.server
-db = Database(Config())
+# Pulled experiments are cached until a new revision is uploaded
+db = Database(Config(), ExperimentCache(max_bytes = 1024 * 2**20))
+# Figures as JSON, keyed by the experiments (and revisions and pyramid levels)
+# they were drawn from, the normalization range and the x axis. Zooming
+# within a level only patches the x axes of a cached figure.
+figure_cache = FigureCache(max_bytes = 128 * 2**20)
+
+# About one point per pixel across a plot. Experiments are pulled at the
+# coarsest stored level that still gives this many points in the view range.
+plot_points = 1500
+
+# Most experiments pulled at once for a comparison. Threads are only started
+# as needed, so a 10 experiment comparison pulls all 10 together.
+compare_jobs = 16
+
+@server.route(url_basename + 'metrics')
+def metrics():
+    # database request latencies and cache hit counts, as JSON
+    return jsonify(dict(
+        db.metrics(),
+        figures = {
+            'figure_sets': len(figure_cache.entries),
+            'bytes': figure_cache.size,
+            'hits': figure_cache.hits,
+            'misses': figure_cache.misses
+        }
+    ))
 
 channel_dict = {
     '2475ChA ex280/em350': 'Trp',
     '2475ChB ex488/em509': 'GFP'
 }
 
-def get_hplc_graphs(exp, view_range = None, x_ax = 'mL'):
+# HPLC channels are stacked in rows this far apart (a fraction of the plot
+# height), with the channel names in the right margin
+facet_spacing = 0.03
+
+def compact_values(values):
+    # Six significant figures of the trace's largest value, so each point is
+    # a few characters of JSON rather than every digit of a float32
+    values = values.astype(np.float64)
+    finite = np.abs(values[np.isfinite(values)])
+    if finite.size == 0 or finite.max() == 0:
+        return values
+
+    return np.round(values, max(0, 6 - int(np.ceil(np.log10(finite.max())))))
+
+def x_values(x):
+    # evenly spaced x values are sent as a start and step
+    regular = grid(x, np.array([0]), np.array([len(x)]))
+    if regular is not None:
+        return {'x0': float(regular[0][0]), 'dx': float(regular[1][0])}
+
+    return {'x': compact_values(x)}
+
+def facet_layout(channels, x_ax):
+    # One row per channel, the first on top. Axes are numbered from the
+    # bottom row, whose x axis the others follow, as in plotly express.
+    height = (1 - facet_spacing * (len(channels) - 1)) / len(channels)
+    layout = {
+        'legend': {'title': {'text': 'Sample'}, 'tracegroupgap': 0},
+        'margin': {'t': 60},
+        'annotations': []
+    }
+    axes = {}
+
+    for i, channel in enumerate(channels):
+        row = len(channels) - i
+        suffix = str(row) if row > 1 else ''
+        bottom = (row - 1) * (height + facet_spacing)
+        axes[channel] = suffix
+
+        layout[f'xaxis{suffix}'] = {'anchor': f'y{suffix}', 'domain': [0, 0.98]}
+        layout[f'yaxis{suffix}'] = {'anchor': f'x{suffix}', 'domain': [bottom, bottom + height], 'title': {'text': 'Value'}}
+        if row > 1:
+            layout[f'xaxis{suffix}'].update(matches = 'x', showticklabels = False)
+
+        layout['annotations'].append({
+            'showarrow': False,
+            'text': channel,
+            'textangle': 90,
+            'x': 0.98,
+            'xanchor': 'left',
+            'xref': 'paper',
+            'y': bottom + height / 2,
+            'yanchor': 'middle',
+            'yref': 'paper'
+        })
+
+    layout['xaxis']['title'] = {'text': 'Time (min)' if x_ax == 'Time' else x_ax}
+
+    return layout, axes
+
+def get_hplc_graphs(exp, x_ax = 'mL'):
+    # WebGL traces built straight from the arrays of each sample and channel
     exp.rename_channels(channel_dict)
-    raw_graphs = []
+    hplc = exp.wide_hplc
 
-    for norm in ['Signal', 'Normalized']:
+    rows = hplc.groupby(['Sample', 'Channel'], observed = True, sort = False).indices
+    samples = list(dict.fromkeys(x[0] for x in rows))
+    channels = list(dict.fromkeys(x[1] for x in rows))
+    layout, axes = facet_layout(channels, x_ax)
 
-        fig = px.line(
-            data_frame = exp.hplc.loc[exp.hplc['Normalization'] == norm],
-            x = x_ax,
-            y = 'Value',
-            color = 'Sample',
-            facet_row = 'Channel',
-            template = 'plotly_white'
-        )
+    # the x values of a trace are the same in both figures
+    x = hplc[x_ax].to_numpy()
+    xs = {key: x_values(x[index]) for key, index in rows.items()}
 
+    raw_graphs = []
+    for norm in ['Signal', 'Normalized']:
+        values = hplc[norm].to_numpy()
+        traces = []
+
+        for i, sample in enumerate(samples):
+            color = px.colors.qualitative.Plotly[i % len(px.colors.qualitative.Plotly)]
+            sample_channels = [x for x in channels if (sample, x) in rows]
+
+            for channel in sample_channels:
+                traces.append({
+                    'type': 'scattergl',
+                    'mode': 'lines',
+                    'name': sample,
+                    'legendgroup': sample,
+                    'showlegend': channel == sample_channels[0],
+                    'line': {'color': color, 'dash': 'solid'},
+                    'hovertemplate': f'Sample={sample}<br>Channel={channel}<br>{x_ax}=%{{x}}<br>Value=%{{y}}<extra></extra>',
+                    'xaxis': f'x{axes[channel]}',
+                    'yaxis': f'y{axes[channel]}',
+                    'y': compact_values(values[rows[(sample, channel)]]),
+                    **xs[(sample, channel)]
+                })
+
+        figure_layout = copy.deepcopy(layout)
+        figure_layout['template'] = pio.templates['plotly_white']
+
+        # normalized channels share the 0 to 1 range, raw signals each get
+        # their own
         if norm == 'Normalized':
-            print('fixing axes')
-            fig.update_layout(yaxis_range=[0, 1])
-        else:
-            try:
-                # without this, your channels are stuck using the same yaxis range
-                fig.layout.yaxis2.update(matches = None)
-            except AttributeError:
-                # if the trace only has one channel, it doesn't have yaxis2
-                pass
-
-        # remove 'Channel=' from the facet labels
-        fig.for_each_annotation(lambda a: a.update(text=a.text.split("=")[-1]))
+            figure_layout['yaxis']['range'] = [0, 1]
+            for suffix in axes.values():
+                if suffix:
+                    figure_layout[f'yaxis{suffix}']['matches'] = 'y'
 
-        if x_ax == 'Time':
-            fig.update_layout(xaxis_title = 'Time (min)')
-
-        raw_graphs.append(fig)
-
-        if view_range is not None:
-            fig.update_xaxes(autorange = False, range = view_range)
-
-        
+        raw_graphs.append({'data': traces, 'layout': figure_layout})
 
     return raw_graphs
 
 def get_fplc_graphs(exp):
-    fplc = exp.fplc
+    fplc = exp.wide_fplc
 
     if fplc is None:
         return None
@@ -75,13 +180,13 @@ def get_fplc_graphs(exp):
     # when non-continuous fractions are selected.
     
     if len(samples) == 1:
-        fplc = fplc.loc[(fplc.Normalization == 'Signal') & (fplc.Channel == 'mAU')]
+        fplc = fplc.loc[fplc.Channel == 'mAU']
         fplc_graph = go.Figure()
         for frac in set(fplc['Fraction']):
             fplc_graph.add_trace(
                 go.Scatter(
                     x = fplc[fplc.Fraction == frac]['mL'],
-                    y = fplc[fplc.Fraction == frac]['Value'],
+                    y = fplc[fplc.Fraction == frac]['Signal'],
                     mode = 'lines',
                     fill = 'tozeroy',
                     visible = 'legendonly',
@@ -94,7 +199,7 @@ def get_fplc_graphs(exp):
             # to give overall sense of quality of trace
             go.Scatter(
                 x = fplc['mL'],
-                y = fplc['Value'],
+                y = fplc['Signal'],
                 mode = 'lines',
                 showlegend = False,
                 hovertemplate = 'mAU: %{y}<br>Volume: %{x}<br>Fraction: %{text}',
@@ -103,6 +208,8 @@ def get_fplc_graphs(exp):
             )
         )
     else:
+        # faceting by normalization needs the long format
+        fplc = exp.fplc
         fplc = fplc.loc[(fplc.Channel == 'mAU')]
         fplc_graph = px.line(
             data_frame = fplc,
@@ -125,17 +232,30 @@ def get_fplc_graphs(exp):
     fplc_graph.for_each_annotation(lambda a: a.update(text=a.text.split("=")[-1]))
     return fplc_graph
 
-def get_plotly(exp, view_range = None, x_ax = 'mL'):
-    combined_graphs = {}
+def get_figures(exp, x_ax = 'mL'):
+    # JSON of each figure, showing the whole x range
+    figures = {}
+
+    if exp.wide_hplc is not None:
+        figures['Signal'], figures['Normalized'] = get_hplc_graphs(exp, x_ax)
+
+    if exp.wide_fplc is not None:
+        figures['FPLC'] = get_fplc_graphs(exp)
+
+    return {data_type: pio.to_json(figure, validate = False) for data_type, figure in figures.items()}
+
+def get_plotly(figures, view_range = None):
     html_graphs = []
-    
-    if exp.hplc is not None:
-        combined_graphs['Signal'], combined_graphs['Normalized'] = get_hplc_graphs(exp, view_range, x_ax)
 
-    if exp.fplc is not None:
-        combined_graphs['FPLC'] = get_fplc_graphs(exp)
+    for data_type, figure in figures.items():
+        figure = json.loads(figure)
+
+        # the HPLC x axes are all set to the view range
+        if view_range is not None and data_type != 'FPLC':
+            for name, axis in figure['layout'].items():
+                if name.startswith('xaxis'):
+                    axis.update(autorange = False, range = view_range)
 
-    for data_type in combined_graphs.keys():
         html_graphs.extend([
                 html.H5(
                     children = data_type,
@@ -144,7 +264,7 @@ def get_plotly(exp, view_range = None, x_ax = 'mL'):
                 dcc.Graph(
                     style={'height': 600},
                     id=f'data-{data_type}',
-                    figure=combined_graphs[data_type]
+                    figure=figure
                 )
             ])
 
@@ -258,7 +378,9 @@ def serve_layout():
             html.Div(
                 className = 'graphs',
                 children = html.Div(id = 'main_graphs')
-            )
+            ),
+            # the figure_key of what main_graphs shows
+            dcc.Store(id = 'figure-key')
         ]
     )
 
@@ -273,6 +395,32 @@ def update_output(pathname):
     experiment_name = pathname.replace(url_basename, '').replace('+', ' and ')
     return f'{experiment_name}'
 
+# Search experiments by sample, channel, sample set or method as you type.
+# Labels include the matching value so the dropdown's own filter keeps them.
+
+@app.callback(
+    dash.dependencies.Output('experiment_dropdown', 'options'),
+    [dash.dependencies.Input('experiment_dropdown', 'search_value')],
+    [dash.dependencies.State('experiment_dropdown', 'value')]
+)
+def search_experiments(search_value, value):
+    options = [{'label': x, 'value': x} for x in value or []]
+
+    # clearing the search, or picking an experiment, lists every experiment
+    # again
+    if not search_value:
+        options.extend({'label': x, 'value': x} for x in db.update_experiment_list() if x not in (value or []))
+        return options
+
+    for id, matches in sorted(db.search_experiments(search_value).items()):
+        if id in (value or []):
+            continue
+
+        label = ', '.join(f'{field} {match}' for field, match in matches)
+        options.append({'label': f'{id} ({label})' if label else id, 'value': id})
+
+    return options
+
 # Make URL pathname the experiment name(s)
 
 @app.callback(
@@ -286,7 +434,10 @@ def update_output(value):
 # load graphs, normalize experiment, update query string
 
 @app.callback(
-    dash.dependencies.Output('main_graphs', 'children'),
+    [
+        dash.dependencies.Output('main_graphs', 'children'),
+        dash.dependencies.Output('figure-key', 'data')
+    ],
     [
         dash.dependencies.Input('root-location', 'pathname'),
         dash.dependencies.Input('root-location', 'search'),
@@ -294,12 +445,13 @@ def update_output(value):
         dash.dependencies.Input('renorm-hplc', 'n_clicks'),
         dash.dependencies.Input('reset-norm', 'n_clicks'),
         dash.dependencies.Input('reset-hplc', 'n_clicks')
-    ]
+    ],
+    [dash.dependencies.State('figure-key', 'data')]
 )
-def update_output(pathname, search_string, radio_value, renorm, reset_norm, reset):
+def update_output(pathname, search_string, radio_value, renorm, reset_norm, reset, shown_key):
     changed = [p['prop_id'] for p in dash.callback_context.triggered][0]
 
-    if changed == 'root-location.search' or changed is None:
+    if changed is None:
         raise dash.exceptions.PreventUpdate
 
     if pathname != '':
@@ -312,16 +464,40 @@ def update_output(pathname, search_string, radio_value, renorm, reset_norm, rese
         if changed == 'renorm-hplc.n_clicks':
             norm_range = view_range
 
-        if len(experiment_name_list) == 1:
-            exp = db.pull_experiment(experiment_name_list[0])
-        else:
-            exp_list = [db.pull_experiment(x) for x in experiment_name_list]
-            exp = concat_experiments(exp_list)
+        # zooming changes the search string, which pulls finer data if needed.
+        # The documents alone say which data that would be.
+        docs = [x for x in db.get_docs(experiment_name_list) if x is not None]
+        figure_key = (
+            tuple(db.experiment_key(x, plot_points, view_range, radio_value) for x in docs),
+            tuple(norm_range) if norm_range is not None else None,
+            radio_value
+        )
 
-        if norm_range is not None:
-            exp.renormalize_hplc(norm_range, False)
-        
-        return get_plotly(exp, view_range, radio_value)
+        # the browser zooms by itself, so a zoom that maps to the same data
+        # as the graphs already shown needs nothing sent back
+        rendered_key = json.dumps(figure_key)
+        if changed == 'root-location.search' and rendered_key == shown_key:
+            raise dash.exceptions.PreventUpdate
+
+        figures = figure_cache.get(figure_key)
+        if figures is None:
+            # fetched and decoded side by side, so comparing takes about
+            # as long as the slowest experiment
+            exp_list = db.experiments_from_docs(docs, plot_points, view_range, radio_value, jobs = compare_jobs)
+            if len(exp_list) == 1:
+                exp = exp_list[0]
+            else:
+                exp = concat_experiments(exp_list)
+
+            if norm_range is not None:
+                exp.renormalize_hplc(norm_range, False)
+
+            figures = get_figures(exp, radio_value)
+            figure_cache.put(figure_key, figures)
+
+        return get_plotly(figures, view_range), rendered_key
+
+    return None, None
 
 @app.callback(
     dash.dependencies.Output('root-location', 'search'),